@@ -0,0 +1,217 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  fft_benchmark.py
+#
+#  Copyright 2014 Balint Seeber <balint256@gmail.com>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+
+# Times 'fft_tools.calc_fft' over a sweep of parameters on synthetic signals (tones plus noise).
+# Each case also records how far its spectra deviate (in dB) from the float64 ones, to weigh the speed of lower precision.
+# Results are written as JSON, and can be compared against a previous run to catch regressions.
+
+from __future__ import print_function
+
+import sys, json, itertools, platform, timeit, tracemalloc
+
+from optparse import OptionParser
+
+import numpy
+
+import fft_tools
+
+WINDOWS = {
+	'none': None,
+	'hamming': numpy.hamming,
+	'hanning': numpy.hanning,
+	'blackman': numpy.blackman,
+	'bartlett': numpy.bartlett,
+}
+
+TONES = [(-0.3125, 0.5), (0.05, 0.1), (0.2, 0.01)]	# (Normalised frequency, amplitude)
+NOISE_AMPLITUDE = 0.01
+
+MEMORY_SLACK = 64 * 1024	# Peak memory growth (bytes) ignored when comparing
+RETAINED_SLACK = 4 * 1024	# Growth (bytes) of memory still held after a call ignored when comparing
+
+def make_signal(length, seed=0):
+	# Complex samples within [-1,1], as 'calc_fft' expects
+	rng = numpy.random.RandomState(seed)
+	t = numpy.arange(length)
+	samps = NOISE_AMPLITUDE * (rng.standard_normal(length) + 1j * rng.standard_normal(length))
+	for freq, amplitude in TONES:
+		samps += amplitude * numpy.exp(2j * numpy.pi * freq * t)
+	return samps.astype(numpy.complex64)
+
+def parse_list(value, convert=str):
+	return [convert(x.strip()) for x in value.split(',') if len(x.strip()) > 0]
+
+def parse_bool(value):
+	return value.lower() in ['1', 'true', 'yes', 'on']
+
+def case_key(case):
+	return ",".join(["%s=%s" % (name, case[name]) for name in sorted(case.keys())])
+
+def db_deviation(samps, kwds):
+	# Largest difference (dB) of the avg/min/max spectra from the same case computed in float64
+	kwds = dict(kwds, log_scale=True)
+	if kwds['dtype'] == numpy.float64:
+		return 0.0
+	results = fft_tools.calc_fft(samps, **kwds)
+	reference = fft_tools.calc_fft(samps, **dict(kwds, dtype=numpy.float64))
+	deviation = 0.0
+	for x, y in zip(results[1:4], reference[1:4]):
+		x = numpy.asarray(x, dtype=numpy.float64)
+		finite = numpy.isfinite(x) & numpy.isfinite(y)
+		if numpy.any(finite != (numpy.isfinite(x) | numpy.isfinite(y))):
+			return float('inf')	# A bin is -inf in only one of them
+		if numpy.any(finite):
+			deviation = max(deviation, float(numpy.max(numpy.abs(x[finite] - y[finite]))))
+	return deviation
+
+def run_case(samps, case, repeat=5):
+	kwds = dict(num_bins=case['num_bins'], log_scale=case['log_scale'], step=case['step'], window=WINDOWS[case['window']], pad=case['pad'], overlap=case['overlap'], dtype=numpy.dtype(case['dtype']))
+	samps = samps[:case['length']]
+
+	cnt = fft_tools.calc_fft(samps, **kwds)[0]	# Warm up (window cache, FFT backend choice and plans)
+
+	best = None
+	for i in range(repeat):
+		start = timeit.default_timer()
+		fft_tools.calc_fft(samps, **kwds)
+		elapsed = timeit.default_timer() - start
+		if best is None or elapsed < best:
+			best = elapsed
+
+	tracemalloc.start()	# Separate run: tracing slows allocation down
+	try:
+		fft_tools.calc_fft(samps, **kwds)	# Results are dropped, so what is still traced was kept by the call (caches, leaks)
+		retained, peak = tracemalloc.get_traced_memory()
+	finally:
+		tracemalloc.stop()
+
+	return {
+		'frames': cnt,
+		'seconds': best,
+		'frames_per_sec': cnt / best,
+		'samples_per_sec': len(samps) / best,
+		'peak_bytes': peak,
+		'retained_bytes': retained,
+		'max_db_error': db_deviation(samps, kwds),	# Against float64
+	}
+
+def compare(baseline, results, threshold):
+	# Returns the regressions (slower by more than 'threshold', using more peak memory, or keeping more memory after a call) against 'baseline'
+	baseline_cases = dict([(case['key'], case) for case in baseline['cases']])
+	regressions = []
+	for case in results['cases']:
+		base = baseline_cases.get(case['key'])
+		if base is None:
+			continue
+		speed = case['samples_per_sec'] / base['samples_per_sec']
+		memory = case['peak_bytes'] - base['peak_bytes']
+		retained = case['retained_bytes'] - base.get('retained_bytes', 0)
+		status = "ok"
+		if speed < (1.0 - threshold):
+			status = "SLOWER"
+		elif memory > max(MEMORY_SLACK, base['peak_bytes'] * threshold):
+			status = "MEMORY"
+		elif retained > RETAINED_SLACK:
+			status = "RETAINED"
+		print("%-8s %6.2fx speed %+12d bytes  %s" % (status, speed, memory, case['key']))
+		if status != "ok":
+			regressions += [(case['key'], status, speed, memory)]
+	return regressions
+
+def main():
+	parser = OptionParser(usage="%prog: [options]")
+
+	parser.add_option("-s", "--sizes", type="string", default="1024,4096,16384", help="FFT sizes [default=%default]")
+	parser.add_option("-l", "--lengths", type="string", default="1048576", help="input lengths in samples [default=%default]")
+	parser.add_option("-w", "--windows", type="string", default="hamming,none", help="windows (%s) [default=%%default]" % (",".join(sorted(WINDOWS.keys()))))
+	parser.add_option("-S", "--steps", type="string", default="1", help="frame steps [default=%default]")
+	parser.add_option("-O", "--overlaps", type="string", default="0,0.5", help="frame overlaps [default=%default]")
+	parser.add_option("-d", "--dtypes", type="string", default="float64,float32", help="precisions [default=%default]")
+	parser.add_option("-p", "--pads", type="string", default="1", help="tail padding settings [default=%default]")
+	parser.add_option("-L", "--logs", type="string", default="1", help="log scaling settings [default=%default]")
+	parser.add_option("-r", "--repeat", type="int", default=5, help="timed runs per case (best is kept) [default=%default]")
+	parser.add_option("-B", "--backend", type="string", default=None, help="FFT backend (%s, or auto) [default=fft_tools default]" % (",".join(fft_tools.available_fft_backends())))
+	parser.add_option("", "--seed", type="int", default=0, help="noise seed [default=%default]")
+	parser.add_option("-o", "--output", type="string", default=None, help="JSON results file [default=%default]")
+	parser.add_option("-b", "--baseline", type="string", default=None, help="JSON results file to compare against [default=%default]")
+	parser.add_option("-t", "--threshold", type="float", default=0.1, help="allowed fractional slowdown or memory growth [default=%default]")
+
+	(options, args) = parser.parse_args()
+
+	if options.backend is not None:
+		fft_tools.set_fft_backend(options.backend)
+
+	sweep = [
+		('num_bins', parse_list(options.sizes, int)),
+		('length', parse_list(options.lengths, int)),
+		('window', parse_list(options.windows)),
+		('step', parse_list(options.steps, int)),
+		('overlap', parse_list(options.overlaps, float)),
+		('dtype', parse_list(options.dtypes)),
+		('pad', parse_list(options.pads, parse_bool)),
+		('log_scale', parse_list(options.logs, parse_bool)),
+	]
+	for window in dict(sweep)['window']:
+		if window not in WINDOWS:
+			print("Unknown window:", window)
+			return 1
+
+	samps = make_signal(max(dict(sweep)['length']), options.seed)
+
+	results = {
+		'python': platform.python_version(),
+		'numpy': numpy.__version__,
+		'platform': platform.platform(),
+		'fft_backend': options.backend or fft_tools.FFT_BACKEND,
+		'repeat': options.repeat,
+		'cases': [],
+	}
+
+	names = [name for name, values in sweep]
+	for values in itertools.product(*[values for name, values in sweep]):
+		case = dict(zip(names, values))
+		key = case_key(case)
+		case.update(run_case(samps, case, options.repeat))
+		case['key'] = key
+		results['cases'] += [case]
+		print("%12.0f frames/s %14.0f samples/s %12d bytes %8d kept %10.2e dB  %s" % (case['frames_per_sec'], case['samples_per_sec'], case['peak_bytes'], case['retained_bytes'], case['max_db_error'], key))
+		sys.stdout.flush()
+
+	if options.output is not None:
+		with open(options.output, 'w') as f:
+			json.dump(results, f, indent=1, sort_keys=True)
+
+	if options.baseline is not None:
+		with open(options.baseline) as f:
+			baseline = json.load(f)
+		print("Comparing with", options.baseline)
+		regressions = compare(baseline, results, options.threshold)
+		if len(regressions) > 0:
+			print("%d regressions" % (len(regressions)))
+			return 1
+
+	return 0
+
+if __name__ == '__main__':
+	sys.exit(main())
@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  detect_tools.py
+#  
+#  Copyright 2014 Balint Seeber <balint256@gmail.com>
+#  
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#  
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#  
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#  
+#  
+
+import numpy
+from numpy.lib.stride_tricks import as_strided
+
+import fft_tools
+
+MEDIAN_BLOCK_BINS = 2**16   # Bins processed at a time by the sliding median (caps the size of the strided copy)
+
+detection_dtype = numpy.dtype([
+    ('bin', numpy.int64),       # Peak bin
+    ('start_bin', numpy.int64), # First bin above the threshold
+    ('end_bin', numpy.int64),   # Last bin above the threshold
+    ('freq', numpy.float64),    # Of the peak bin (Hz, or in bins if the sample rate is unknown)
+    ('bandwidth', numpy.float64),   # Of the bins above the threshold (Hz, or in bins)
+    ('power', numpy.float64),   # Peak power (dB)
+    ('noise', numpy.float64),   # Noise floor at the peak (dB)
+    ('snr', numpy.float64),     # dB
+])
+
+def _to_linear(spectrum, log_scale=True):
+    spectrum = numpy.asarray(spectrum, dtype=numpy.float64)
+    if log_scale:
+        return 10.0 ** (spectrum / 10.0)
+    return spectrum
+
+def _to_db(power):
+    with numpy.errstate(divide='ignore'):
+        return 10.0 * numpy.log10(power)
+
+# Cell-averaging CFAR: mean of 'train_bins' cells either side of each bin, skipping 'guard_bins' cells next to it.
+# Near the ends only the cells that exist are used. Cost is O(bins) from a cumulative sum.
+def noise_floor_ca(spectrum, train_bins=32, guard_bins=4, log_scale=True):
+    power = _to_linear(spectrum, log_scale)
+    n = len(power)
+    cumulative = numpy.concatenate(([0.0], numpy.cumsum(power)))
+    idx = numpy.arange(n)
+
+    def _window_sum(start, end):    # Sum of 'power[start:end]', clipped to the spectrum
+        start = numpy.clip(start, 0, n)
+        end = numpy.clip(end, 0, n)
+        return (cumulative[end] - cumulative[start]), (end - start)
+
+    left_sum, left_cnt = _window_sum(idx - guard_bins - train_bins, idx - guard_bins)
+    right_sum, right_cnt = _window_sum(idx + guard_bins + 1, idx + guard_bins + 1 + train_bins)
+    noise = (left_sum + right_sum) / numpy.maximum(left_cnt + right_cnt, 1)
+
+    if log_scale:
+        return _to_db(noise)
+    return noise
+
+# Median of the same training cells as 'noise_floor_ca' (more robust next to strong signals).
+# The spectrum is reflected at the ends, and windows come from a strided view processed 'MEDIAN_BLOCK_BINS' at a time.
+def noise_floor_median(spectrum, train_bins=32, guard_bins=4, log_scale=True):
+    spectrum = numpy.asarray(spectrum, dtype=numpy.float64)
+    n = len(spectrum)
+    half = guard_bins + train_bins
+    padded = numpy.pad(spectrum, half, mode='reflect' if n > half else 'edge')
+    width = (2 * half) + 1
+    cells = numpy.concatenate((numpy.arange(train_bins), numpy.arange(half + guard_bins + 1, width)))  # Training cells in each window
+
+    stride = padded.strides[0]
+    windows = as_strided(padded, shape=(n, width), strides=(stride, stride), writeable=False)
+    noise = numpy.empty(n)
+    for i in range(0, n, MEDIAN_BLOCK_BINS):
+        noise[i:i+MEDIAN_BLOCK_BINS] = numpy.median(windows[i:i+MEDIAN_BLOCK_BINS][:, cells], axis=1)   # dB and linear medians agree
+
+    return noise
+
+# Finds runs of bins at least 'threshold' dB above the noise floor (estimated with 'method': 'ca' or 'median') in a spectrum
+# from 'fft_tools.calc_fft' (dB if 'log_scale'), and returns one 'detection_dtype' record per run of at least 'min_bins'.
+# Frequencies use 'samp_rate' and 'freq' (or those of 'input_file', an 'input_file.InputFile'); without a sample rate they are in bins.
+# For a one-sided ('real') spectrum, 'num_bins' is the FFT size if it was odd.
+def detect(spectrum, threshold=10.0, method='ca', train_bins=32, guard_bins=4, min_bins=1, log_scale=True, samp_rate=None, freq=0.0, real=False, num_bins=None, input_file=None, noise=None):
+    spectrum = numpy.asarray(spectrum, dtype=numpy.float64)
+    n = len(spectrum)
+
+    if input_file is not None:
+        if samp_rate is None:
+            samp_rate = input_file.sample_rate()
+        if input_file.freq() is not None:
+            freq = input_file.freq()
+
+    power_db = spectrum
+    if not log_scale:
+        power_db = _to_db(spectrum)
+
+    if noise is None:
+        if method == 'ca':
+            noise = noise_floor_ca(power_db, train_bins, guard_bins)
+        elif method == 'median':
+            noise = noise_floor_median(power_db, train_bins, guard_bins)
+        else:
+            raise Exception("Unknown noise floor method: {}".format(method))
+    noise = numpy.asarray(noise, dtype=numpy.float64)
+
+    snr = power_db - noise
+    above = (snr >= threshold)
+
+    edges = numpy.diff(numpy.concatenate(([False], above, [False])).astype(numpy.int8))
+    starts = numpy.flatnonzero(edges == 1)
+    ends = numpy.flatnonzero(edges == -1)  # Exclusive
+    keep = ((ends - starts) >= min_bins)
+    starts = starts[keep]
+    ends = ends[keep]
+
+    detections = numpy.zeros(len(starts), dtype=detection_dtype)
+    if len(starts) == 0:
+        return detections
+
+    # Peak of each run: the first bin in the run that equals the run's maximum
+    delta = numpy.zeros(n + 1, dtype=numpy.int64)
+    delta[starts] += 1
+    delta[ends] -= 1
+    in_run = (numpy.cumsum(delta[:-1]) > 0) # Only runs that were kept
+    run_max = numpy.maximum.reduceat(numpy.where(in_run, power_db, -numpy.inf), starts)
+    candidates = numpy.flatnonzero(in_run)
+    candidate_runs = numpy.searchsorted(starts, candidates, side='right') - 1
+    is_peak = (power_db[candidates] == run_max[candidate_runs])
+    runs, first = numpy.unique(candidate_runs[is_peak], return_index=True)
+    peaks = candidates[is_peak][first]
+
+    if num_bins is None:
+        num_bins = n
+        if real:
+            num_bins = (n - 1) * 2
+    freqs = numpy.arange(n, dtype=numpy.float64)
+    bin_width = 1.0
+    if samp_rate is not None:
+        freqs = fft_tools.calc_freqs(num_bins, samp_rate, freq, real)
+        bin_width = 1.0 * samp_rate / num_bins
+
+    detections['bin'] = peaks
+    detections['start_bin'] = starts
+    detections['end_bin'] = ends - 1
+    detections['freq'] = freqs[peaks]
+    detections['bandwidth'] = (ends - starts) * bin_width
+    detections['power'] = power_db[peaks]
+    detections['noise'] = noise[peaks]
+    detections['snr'] = snr[peaks]
+
+    return detections
+
+# 'detect' on one of the spectra in the results of 'fft_tools.calc_fft' ('which' is 'avg', 'min' or 'max')
+def detect_results(results, which='avg', **kwds):
+    spectrum = results[{'avg': 1, 'min': 2, 'max': 3}[which]]
+    return detect(spectrum, **kwds)
@@ -22,107 +22,1202 @@
 #  
 #  
 
-import sys, math
+import sys, math, threading, collections, multiprocessing, datetime, json, timeit
 
 import numpy
+from numpy.lib.stride_tricks import as_strided
 
-# Assumes normalised input values [-1,1]
-def calc_fft(samps, num_bins=None, log_scale=True, step=1, window=numpy.hamming, pad=True, adjust=True, verbose=False, ref_scale=2.0):#, real=False):  # FIXME: step (when it was floating point, for more flexible overlap)
-    if len(samps) == 0:
-        return (0, numpy.array([]), numpy.array([]), numpy.array([]))
+try:
+    import scipy.fft as scipy_fft
+except ImportError:
+    scipy_fft = None
 
-    step = max(1, int(step))    # Stride (of 'num_bins') used in processing loop below
+try:
+    import pyfftw
+    import pyfftw.builders
+except ImportError:
+    pyfftw = None
 
-    if num_bins is None:
-        num_bins = len(samps)
+import input_file
 
-    num_ffts = len(samps)/num_bins  # If less 'samps' than 'num_bins', will zero pad
+DEFAULT_CHUNK_SAMPLES = 2**20 # Upper bound on samples transformed per batched FFT call (caps peak memory)
+DEFAULT_BLOCK_SAMPLES = 2**20 # Samples read from a file at a time
+WATERFALL_HEADER_ALIGN = 4096 # Waterfall file rows start on this boundary (see 'write_waterfall')
+DEFAULT_QUANTILE_RANGE = (-160.0, 40.0)  # dB range of the per-bin quantile histograms (values outside are clipped)
+DEFAULT_QUANTILE_RESOLUTION = 2.0   # dB (quantiles are interpolated within a histogram bin, so coarse bins stay accurate)
+QUANTILE_BLOCK_BINS = 4096  # Spectrum bins whose quantiles are computed at a time (caps the temporaries of 'results')
+ZOOM_TAPS_PER_PHASE = 16    # Length of the zoom decimation filter, per polyphase branch
+ZOOM_OVERSAMPLE = 2.0   # Default zoom output rate, in multiples of the bandwidth (room for the filter's transition band)
+WINDOW_CACHE_SIZE = 64  # Maximum number of (window, length, dtype) entries kept by 'get_window'
+FFT_BACKEND = 'auto'    # Default FFT backend: one of 'available_fft_backends()', or 'auto' to choose per FFT size
+FFT_BACKEND_BENCHMARK = True    # With 'auto', time each available backend the first time an FFT size is used (otherwise prefer pyfftw, then scipy)
+FFT_PLAN_CACHE_SIZE = 32    # Maximum number of pyfftw plans kept per thread
+FFTW_PLANNER_EFFORT = 'FFTW_MEASURE'
 
-    left_over = len(samps) - (num_ffts * num_bins)
-    if left_over > 0:
-        if pad:
-            if verbose: print("Padding %d tail samples for FFT" % (num_bins - left_over))
-            num_ffts += 1
-        else:
-            if verbose: print("Skipping %d tail samples for FFT" % (left_over))
+# 'points' is None (and 'power' is 'length') for a rectangular window.
+# 'adjust_amount' is the dB correction for the number of bins and windowing loss (see '_calc_adjust_amount').
+WindowInfo = collections.namedtuple('WindowInfo', ['points', 'power', 'adjust_amount'])
+
+_window_cache = collections.OrderedDict()
+_window_cache_lock = threading.Lock()
+_window_cache_hits = 0
+_window_cache_misses = 0
 
-    num_ffts = max(1, num_ffts) # Might still be 0 if not padding
-    total_transforms = 1 + ((num_ffts-1) / step)
-    if verbose: print("Processing %d FFTs" % (total_transforms))
+def get_window(window, length, dtype=numpy.float64):
+    global _window_cache_hits, _window_cache_misses
+
+    key = (window, length, numpy.dtype(dtype))
+    with _window_cache_lock:
+        info = _window_cache.pop(key, None)
+        if info is not None:
+            _window_cache_hits += 1
+            _window_cache[key] = info   # Most recently used
+            return info
+        _window_cache_misses += 1
 
-    fft_sum = numpy.zeros(num_bins)
-    fft_max = numpy.zeros(num_bins)
-    # fft_min = numpy.ones(num_bins)
-    fft_min = None
     if window is None:
-        #window_points = numpy.ones(num_bins)
-        window_points = None
+        points = None
+        power = float(length)
     else:
-        window_points = window(num_bins)
-    
-    # if pad:
-    #     pad_amount = num_bins - left_over
-    #     if isinstance(samps, list):
-    #         samps += [0]*pad_amount
-    #     elif isinstance(samps, numpy.ndarray):
-    #         samps = numpy.concatenate((samps, numpy.zeros(pad_amount)))
-    #     else:
-    #         raise Exception("Cannot pad unknown type '%s': %s" % (type(samps), str(samps)))
-    
-    cnt = 0
-    for i in range(0, num_ffts, step):
-        start_idx = i * num_bins
-        end_idx = min(len(samps), start_idx + num_bins)
-        data = numpy.array(samps[start_idx:end_idx])
+        points = numpy.asarray(window(length), dtype=dtype)
+        points.flags.writeable = False  # Shared between callers
+        power = float(numpy.dot(points, points))
 
-        if window_points is not None:
-            if len(data) == num_bins:
-                data *= window_points
+    adjust_amount = None    # Undefined for an all-zero window (e.g. 'numpy.hanning(2)')
+    if power > 0:
+        adjust_amount = -20.0 * math.log10(length)  # Adjust for number of bins
+        if points is not None:
+            adjust_amount += (-10.0 * math.log10(power/length)) # Adjust for windowing loss
+
+    info = WindowInfo(points, power, adjust_amount)
+
+    with _window_cache_lock:
+        _window_cache[key] = info
+        while len(_window_cache) > WINDOW_CACHE_SIZE:
+            _window_cache.popitem(last=False)
+
+    return info
+
+def window_cache_info():
+    # (hits, misses, current size, maximum size)
+    with _window_cache_lock:
+        return (_window_cache_hits, _window_cache_misses, len(_window_cache), WINDOW_CACHE_SIZE)
+
+def clear_window_cache():
+    global _window_cache_hits, _window_cache_misses
+    with _window_cache_lock:
+        _window_cache.clear()
+        _window_cache_hits = 0
+        _window_cache_misses = 0
+
+def _frame_view(samps, num_bins, hop, num_frames):
+    # Zero-copy view of 'samps' with frames along the second-last axis: row 'i' is 'samps[..., i*hop:i*hop+num_bins]'
+    stride = samps.strides[-1]
+    return as_strided(samps, shape=(samps.shape[:-1] + (num_frames, num_bins)), strides=(samps.strides[:-1] + (hop * stride, stride)), writeable=False)
+
+def _calc_hop(num_bins, step=1, overlap=0.0, hop=None):
+    # Distance in samples between the starts of consecutive frames
+    if hop is None:
+        if step <= 0:   # As before fractional steps: every frame
+            step = 1
+        if overlap < 0.0 or overlap >= 1.0:
+            raise Exception("Overlap must be in the range [0,1): {}".format(overlap))
+        hop = int(round(num_bins * step * (1.0 - overlap)))
+    hop = int(hop)
+    if hop < 1:
+        raise Exception("Hop must be at least one sample (num_bins: {}, step: {}, overlap: {}, hop: {})".format(num_bins, step, overlap, hop))
+    return hop
+
+class _numpy_fft_backend():
+    name = 'numpy'
+
+    def __init__(self, workers=None):
+        pass
+
+    def fft(self, frames, num_bins, real=False, out=None):
+        if not _numpy_fft_out:
+            out = None
+        if real:
+            if out is not None:
+                return numpy.fft.rfft(frames, num_bins, axis=-1, out=out)
+            return numpy.fft.rfft(frames, num_bins, axis=-1)
+        if out is not None:
+            return numpy.fft.fft(frames, num_bins, axis=-1, out=out)
+        return numpy.fft.fft(frames, num_bins, axis=-1)
+
+class _scipy_fft_backend():
+    name = 'scipy'
+
+    def __init__(self, workers=None):
+        if workers is None:
+            workers = -1    # All CPUs
+        self._workers = workers
+
+    def fft(self, frames, num_bins, real=False, out=None):  # No 'out' support
+        if real:
+            return scipy_fft.rfft(frames, num_bins, axis=-1, workers=self._workers)
+        return scipy_fft.fft(frames, num_bins, axis=-1, workers=self._workers)
+
+class _pyfftw_fft_backend():
+    name = 'pyfftw'
+
+    def __init__(self, workers=None):
+        if workers is None or workers < 1:
+            workers = multiprocessing.cpu_count()
+        self._threads = workers
+        self._local = threading.local()  # Plans (and their internal buffers) are not shared between threads
+
+    def fft(self, frames, num_bins, real=False, out=None):  # Output is always the plan's own buffer
+        plans = getattr(self._local, 'plans', None)
+        if plans is None:
+            plans = self._local.plans = collections.OrderedDict()
+
+        key = (frames.shape, frames.dtype, num_bins, real)
+        entry = plans.pop(key, None)
+        if entry is None:
+            builder = pyfftw.builders.fft
+            if real:
+                builder = pyfftw.builders.rfft
+            plan = builder(pyfftw.empty_aligned(frames.shape, dtype=frames.dtype), num_bins, axis=-1, threads=self._threads, planner_effort=FFTW_PLANNER_EFFORT)
+            entry = (plan, plan.input_array)    # Internal input (zero padded to 'num_bins' if the frames are shorter)
+            while len(plans) >= FFT_PLAN_CACHE_SIZE:
+                plans.popitem(last=False)
+        plans[key] = entry  # Most recently used
+
+        plan, buf = entry
+        fft = plan(frames)  # Output array belongs to the plan and is overwritten by its next call
+        plan.update_arrays(buf, fft)    # A suitably aligned 'frames' becomes the plan's input: drop it, so cached plans do not keep it alive
+        return fft
+
+_numpy_fft_out = (numpy.lib.NumpyVersion(numpy.__version__) >= '2.0.0')  # 'out' argument to 'numpy.fft'
+
+_fft_backend_types = collections.OrderedDict([(backend.name, backend) for backend in [_numpy_fft_backend, _scipy_fft_backend, _pyfftw_fft_backend]])
+if scipy_fft is None:
+    del _fft_backend_types['scipy']
+if pyfftw is None:
+    del _fft_backend_types['pyfftw']
+
+_fft_backends = {}  # (name, workers): backend
+_fft_backend_choices = {}   # (num_bins, dtype, real, workers): backend chosen by 'auto'
+_fft_backend_lock = threading.RLock()
+
+def available_fft_backends():
+    return list(_fft_backend_types.keys())
+
+def _get_fft_backend_by_name(name, workers=None):
+    if name not in _fft_backend_types:
+        name = 'numpy'  # Optional library not installed
+    key = (name, workers)
+    with _fft_backend_lock:
+        backend = _fft_backends.get(key)
+        if backend is None:
+            backend = _fft_backends[key] = _fft_backend_types[name](workers)
+    return backend
+
+def _benchmark_fft_backend(backend, num_bins, dtype, real, repeat=3):
+    frames = max(1, min(16, (2**16) // num_bins))
+    data = numpy.ones((frames, num_bins), dtype=dtype)
+    if not real:
+        data = data.astype(numpy.result_type(dtype, numpy.complex64))
+    backend.fft(data, num_bins, real)   # Create any plans before timing
+    best = None
+    for i in range(repeat):
+        start = timeit.default_timer()
+        backend.fft(data, num_bins, real)
+        elapsed = timeit.default_timer() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+# The backend used for FFTs of 'num_bins' (of real 'dtype' samples if 'real', otherwise complex).
+# 'name' is one of 'available_fft_backends()', or 'auto' (or None for 'FFT_BACKEND'). Missing libraries fall back to numpy.
+# 'workers' is the number of threads for scipy/pyfftw (default: all CPUs).
+def get_fft_backend(num_bins, dtype=numpy.float64, real=False, name=None, workers=None):
+    if name is None:
+        name = FFT_BACKEND
+    if name != 'auto':
+        return _get_fft_backend_by_name(name, workers)
+
+    dtype = numpy.finfo(dtype).dtype
+    key = (num_bins, dtype, real, workers)
+    with _fft_backend_lock:
+        backend = _fft_backend_choices.get(key)
+        if backend is not None:
+            return backend
+
+        backends = [_get_fft_backend_by_name(name, workers) for name in available_fft_backends()]
+        if FFT_BACKEND_BENCHMARK and len(backends) > 1:
+            timings = [(_benchmark_fft_backend(backend, num_bins, dtype, real), i) for i, backend in enumerate(backends)]
+            backend = backends[min(timings)[1]]
+        else:
+            backend = backends[-1]  # pyfftw, scipy, then numpy
+
+        _fft_backend_choices[key] = backend
+
+    return backend
+
+def set_fft_backend(name, benchmark=None):
+    global FFT_BACKEND, FFT_BACKEND_BENCHMARK
+    if name != 'auto' and name not in ['numpy', 'scipy', 'pyfftw']:
+        raise Exception("Unknown FFT backend: {}".format(name))
+    FFT_BACKEND = name
+    if benchmark is not None:
+        FFT_BACKEND_BENCHMARK = benchmark
+    with _fft_backend_lock:
+        _fft_backend_choices.clear()
+
+def _spectra(frames, num_bins, window_points=None, real=False, backend=None):
+    if window_points is not None:
+        frames = frames * window_points
+    if backend is None:
+        backend = _get_fft_backend_by_name('numpy')
+    return backend.fft(frames, num_bins, real)  # One-sided ('num_bins/2 + 1' bins) if 'real'. Will zero pad if frames are shorter than 'num_bins'
+
+def _power_spectra(frames, num_bins, window_points=None, real=False, backend=None):
+    fft = _spectra(frames, num_bins, window_points, real, backend)
+    power = numpy.square(fft.real)
+    power += numpy.square(fft.imag)
+    return power    # Not shifted: the per-bin reductions are shifted once at the end
+
+def _one_sided_adjust(num_bins, dtype=numpy.float64):
+    # A one-sided spectrum folds the power of the negative frequencies onto the positive ones,
+    # so add 3dB to all bins but the DC bin (and the Nyquist bin, which has no mirror, when 'num_bins' is even)
+    adjust = numpy.empty((num_bins // 2) + 1, dtype=dtype)
+    adjust.fill(10.0 * math.log10(2.0))
+    adjust[0] = 0.0
+    if (num_bins % 2) == 0:
+        adjust[-1] = 0.0
+    return adjust
+
+# Frequency of each bin of a spectrum from 'calc_fft' (or an accumulator), relative to 'freq'
+def calc_freqs(num_bins, samp_rate=1.0, freq=0.0, real=False):
+    if real:
+        return freq + numpy.fft.rfftfreq(num_bins, 1.0 / samp_rate)
+    return freq + numpy.fft.fftshift(numpy.fft.fftfreq(num_bins, 1.0 / samp_rate))
+
+# Magnitude-squared coherence between each pair of channels from a cross-spectral matrix (as returned by 'calc_fft' with 'cross_spectra')
+def calc_coherence(cross_spectra):
+    auto = numpy.real(numpy.diagonal(cross_spectra, axis1=0, axis2=1)).T    # (channels, bins)
+    return numpy.square(numpy.abs(cross_spectra)) / (auto[:, numpy.newaxis, :] * auto[numpy.newaxis, :, :])
+
+def _calc_adjust_amount(window_info, ref_scale=2.0):
+    return (window_info.adjust_amount               # Adjust for number of bins and windowing loss
+            -20.0 * math.log10(ref_scale/2))        # Adjust for reference scale
+
+def _empty_results(quantiles=None, channels=None, cross_spectra=False, track_max=False, track_min=False):
+    shape = (0,)
+    if channels is not None:
+        shape = (channels, 0)
+    results = (0, numpy.zeros(shape), numpy.zeros(shape), numpy.zeros(shape))
+    if quantiles is not None:
+        results += (numpy.zeros((len(quantiles),) + shape),)
+    if cross_spectra:
+        results += (numpy.zeros((channels, channels, 0), dtype=numpy.complex128),)
+    if track_max:
+        results += (numpy.zeros(shape, dtype=numpy.intp),)
+    if track_min:
+        results += (numpy.zeros(shape, dtype=numpy.intp),)
+    return results
+
+def _take_frames(power, idx):
+    # Picks frame 'idx[..., bin]' of each bin ('idx' as returned by 'argmax(axis=-2)')
+    return numpy.take_along_axis(power, idx[..., numpy.newaxis, :], axis=-2)[..., 0, :]
+
+# Accumulates the same statistics as 'calc_fft', but from successive chunks of a stream in constant memory.
+# Frames that straddle chunk boundaries are completed when the next chunk arrives.
+# With 'real', input must be real-valued and the spectra are one-sided (DC to Nyquist, 'num_bins/2 + 1' bins, not shifted).
+# 'dtype' is the precision used throughout (windows, frames, FFTs and results): 'numpy.float32' (or 'complex64') halves memory traffic.
+# 'quantiles' (e.g. '[0.1, 0.5, 0.9]') keeps a histogram in dB per bin ('quantile_range' at 'quantile_resolution') from which
+# approximate per-bin quantile spectra are returned as a 2D array after the usual results (memory does not grow with the number of frames).
+# 'fft_backend' and 'fft_workers' select the FFT implementation (see 'get_fft_backend').
+# With 'channels', input is a '(channels, samples)' array, every channel is transformed in the same FFT calls and
+# results have a leading channel axis. 'cross_spectra' also accumulates the '(channels, channels, bins)' cross-spectral matrix
+# (returned after any quantiles, linear and not adjusted; see 'calc_coherence').
+# 'track_max' (and 'track_min') also return, last, the per-bin index of the frame that held the max (min): frame 'i' starts
+# 'i * hop' samples after the first sample added, as long as no 'flush' came in between (a padded tail frame starts where the next full frame would have).
+class SpectrumAccumulator():
+    def __init__(self, num_bins, step=1, window=numpy.hamming, overlap=0.0, hop=None, chunk_frames=None, adjust=True, ref_scale=2.0, real=False, dtype=numpy.float64, quantiles=None, quantile_range=DEFAULT_QUANTILE_RANGE, quantile_resolution=DEFAULT_QUANTILE_RESOLUTION, fft_backend=None, fft_workers=None, channels=None, cross_spectra=False, track_max=False, track_min=False):
+        self._num_bins = num_bins
+        self._channels = channels
+        self._track_max = track_max
+        self._track_min = track_min
+        self._cross_spectra = cross_spectra
+        if cross_spectra and channels is None:
+            raise Exception("Cross spectra need multi-channel input")
+        self._real = real
+        self._dtype = numpy.finfo(dtype).dtype  # Real counterpart of a complex 'dtype'
+        self._complex_dtype = numpy.result_type(self._dtype, numpy.complex64)
+        self._num_out = num_bins
+        if real:
+            self._num_out = (num_bins // 2) + 1
+        self._hop = _calc_hop(num_bins, step, overlap, hop)
+        self._window = window
+
+        self._shape = (self._num_out,)  # Of each result
+        if channels is not None:
+            self._shape = (channels, self._num_out)
+
+        if chunk_frames is None:
+            chunk_frames = DEFAULT_CHUNK_SAMPLES // (num_bins * (channels or 1))
+        self._chunk_frames = max(1, int(chunk_frames))
+
+        self._fft_backend = get_fft_backend(num_bins, self._dtype, real, fft_backend, fft_workers)
+
+        window_info = get_window(window, num_bins, self._dtype)
+        self._window_points = window_info.points
+
+        self._adjust_amount = 0.0
+        if adjust:
+            self._adjust_amount = _calc_adjust_amount(window_info, ref_scale)
+            if real:
+                self._adjust_amount = self._adjust_amount + _one_sided_adjust(num_bins, self._dtype)
+
+        self._quantiles = None
+        if quantiles is not None:
+            self._quantiles = numpy.array(quantiles, dtype=numpy.float64)
+            self._quantile_min = float(quantile_range[0])
+            self._quantile_resolution = float(quantile_resolution)
+            self._quantile_bins = int(math.ceil((quantile_range[1] - quantile_range[0]) / quantile_resolution))
+            self._quantile_offsets = (numpy.arange(numpy.prod(self._shape)).reshape(self._shape) * self._quantile_bins)[..., numpy.newaxis, :]  # Start of each bin's histogram
+
+        self.reset()
+
+    def reset(self):
+        self._cnt = 0
+        self._sum = numpy.zeros(self._shape, dtype=self._dtype)
+        self._min = None
+        self._max = numpy.zeros(self._shape, dtype=self._dtype)
+        self._pending = numpy.zeros(self._shape[:-1] + (0,), dtype=self._dtype)    # Samples from '_next_start' up to '_position'
+        self._position = 0  # Absolute index of the next sample to be added
+        self._next_start = 0    # Absolute index of the start of the next frame
+        self._covered = 0   # Absolute index of the end of the last processed frame
+        self._histogram = None
+        if self._quantiles is not None:
+            self._histogram = numpy.zeros(self._shape + (self._quantile_bins,), dtype=numpy.uint32)
+        self._cross = None
+        if self._cross_spectra:
+            self._cross = numpy.zeros((self._channels, self._channels, self._num_out), dtype=self._complex_dtype)
+        self._argmax = None
+        if self._track_max:
+            self._argmax = numpy.zeros(self._shape, dtype=numpy.intp)
+        self._argmin = None
+        if self._track_min:
+            self._argmin = numpy.zeros(self._shape, dtype=numpy.intp)
+
+    def _transform(self, frames, window_points):
+        # 'frames' are cast to the accumulator's precision as they are windowed, so at most one chunk of frames is ever copied
+        dtype = self._frames_dtype(frames)
+        if window_points is None:
+            frames = frames.astype(dtype, copy=False)
+        else:
+            frames = numpy.multiply(frames, window_points, dtype=dtype)
+        fft = _spectra(frames, self._num_bins, None, self._real, self._fft_backend)
+        if self._cross is not None:
+            self._cross += numpy.einsum('ifb,jfb->ijb', fft, numpy.conj(fft))
+        power = numpy.square(fft.real)
+        power += numpy.square(fft.imag)
+        self._reduce(power)
+
+    def _reduce(self, power):
+        # 'power' has frames along the second-last axis
+        self._sum += power.sum(axis=-2)
+        if self._argmax is None:
+            numpy.maximum(self._max, power.max(axis=-2), out=self._max)
+        else:
+            idx = power.argmax(axis=-2)
+            self._update_extreme(self._max, self._argmax, _take_frames(power, idx), idx + self._cnt, numpy.greater)
+        if self._argmin is None:
+            fft_min = power.min(axis=-2)
+        else:
+            idx = power.argmin(axis=-2)
+            fft_min = _take_frames(power, idx)
+        if self._min is None:
+            self._min = fft_min
+            if self._argmin is not None:
+                self._argmin[:] = idx + self._cnt
+        elif self._argmin is None:
+            numpy.minimum(self._min, fft_min, out=self._min)
+        else:
+            self._update_extreme(self._min, self._argmin, fft_min, idx + self._cnt, numpy.less)
+        self._cnt += power.shape[-2]
+        if self._histogram is not None:
+            self._update_histogram(power)
+
+    def _update_extreme(self, values, indices, new_values, new_indices, better):
+        # Keeps the earliest frame on ties
+        replace = better(new_values, values)
+        numpy.copyto(values, new_values, where=replace)
+        numpy.copyto(indices, new_indices, where=replace)
+
+    def _update_histogram(self, power):
+        with numpy.errstate(divide='ignore'):
+            idx = numpy.log10(power)
+        idx *= 10.0 / self._quantile_resolution
+        idx += (self._adjust_amount - self._quantile_min) / self._quantile_resolution
+        numpy.clip(idx, 0, self._quantile_bins - 1, out=idx)
+        idx = idx.astype(numpy.intp)
+        idx += self._quantile_offsets
+        histogram = self._histogram.reshape(-1)
+        if idx.size >= histogram.size: # Counting every histogram bin is cheaper than scattered adds (and no larger than 'idx')
+            numpy.add(histogram, numpy.bincount(idx.reshape(-1), minlength=histogram.size), out=histogram, casting='unsafe')
+        else:
+            numpy.add.at(histogram, idx.reshape(-1), 1)
+
+    def _calc_quantiles(self, log_scale=True):
+        histograms = self._histogram.reshape(-1, self._quantile_bins)
+        values = numpy.empty((len(self._quantiles), len(histograms)), dtype=self._dtype)
+        for first in range(0, len(histograms), QUANTILE_BLOCK_BINS):
+            histogram = histograms[first:first+QUANTILE_BLOCK_BINS]
+            cumulative = numpy.cumsum(histogram, axis=1, dtype=histogram.dtype)  # Not promoted to 64 bits
+            rows = numpy.arange(len(histogram))
+            for i, q in enumerate(self._quantiles):
+                target = q * self._cnt
+                idx = numpy.argmax(cumulative >= target, axis=1)
+                below = numpy.where(idx > 0, cumulative[rows, idx - 1], 0)
+                frac = (target - below) / numpy.maximum(histogram[rows, idx], 1) # Interpolate within the histogram bin
+                values[i, first:first+len(histogram)] = self._quantile_min + ((idx + frac) * self._quantile_resolution)
+        values = values.reshape((len(self._quantiles),) + self._shape)
+        if not log_scale:
+            values = 10.0 ** ((values - self._adjust_amount) / 10.0)
+        if not self._real:
+            values = numpy.fft.fftshift(values, axes=-1)
+        return values
+
+    def _frames_dtype(self, samps):
+        # Precision that frames of 'samps' are processed in
+        if numpy.iscomplexobj(samps):
+            return self._complex_dtype
+        return self._dtype
+
+    def _process(self, buf, buf_idx, limit=None):
+        # Process the full frames in 'buf' (which starts at absolute index 'buf_idx'), optionally only those starting before 'limit'
+        offset = self._next_start - buf_idx
+        if offset + self._num_bins > buf.shape[-1]:
+            return
+        num_frames = 1 + ((buf.shape[-1] - offset - self._num_bins) // self._hop)
+        if limit is not None:
+            num_frames = min(num_frames, (limit - self._next_start + self._hop - 1) // self._hop)
+        if num_frames <= 0:
+            return
+
+        frames = _frame_view(buf[..., offset:], self._num_bins, self._hop, num_frames)
+        for i in range(0, num_frames, self._chunk_frames):
+            self._transform(frames[..., i:i+self._chunk_frames, :], self._window_points)
+
+        self._next_start += num_frames * self._hop
+        self._covered = self._next_start - self._hop + self._num_bins
+
+    def add(self, samps):
+        samps = numpy.asarray(samps)
+        if numpy.iscomplexobj(samps) and self._real:
+            raise Exception("Complex samples supplied to real spectrum accumulator")
+        dtype = self._frames_dtype(samps)
+        if samps.shape[:-1] != self._shape[:-1]:
+            raise Exception("Expected samples of shape {} + (samples,), got {}".format(self._shape[:-1], samps.shape))
+        samps_idx = self._position
+        self._position += samps.shape[-1]
+
+        if self._pending.shape[-1] > 0:
+            # Complete the frames that start in the pending samples (they will be less than 'num_bins' long)
+            pending = self._pending
+            head_idx = samps_idx - pending.shape[-1]
+            self._process(numpy.concatenate((pending, samps[..., :self._num_bins-1].astype(dtype, copy=False)), axis=-1), head_idx, limit=samps_idx)
+            if self._next_start < samps_idx:
+                self._pending = numpy.concatenate((pending[..., self._next_start-head_idx:], samps.astype(dtype, copy=False)), axis=-1)
+                return
+            self._pending = pending[..., :0]
+
+        self._process(samps, samps_idx)
+
+        if self._next_start < self._position:
+            self._pending = samps[..., self._next_start-samps_idx:].astype(dtype)   # Copied, in the accumulator's precision
+
+    def flush(self, pad=True, verbose=False):
+        # Deal with the samples that do not make up a full frame (e.g. at the end of a stream). Framing restarts with the next added sample.
+        num_pending = self._pending.shape[-1]
+        if num_pending > 0 and self._covered < self._position:   # Pending holds samples not in any full frame
+            if pad:
+                if verbose: print("Padding %d tail samples for FFT" % (self._num_bins - num_pending))
+                window_points = get_window(self._window, num_pending, self._dtype).points # Shorter window
+                self._transform(self._pending[..., numpy.newaxis, :], window_points)
             else:
-                data *= window(len(data))   # Shorter window
-
-        fft = numpy.fft.fft(data, num_bins) # Will zero pad if 'len(data)' < 'num_bins'
-        fft = numpy.fft.fftshift(fft)
-        fft = numpy.abs(fft)
-        
-        fft = (fft * fft)
-        fft_sum += fft
-        if fft_min is None:
-            fft_min = fft
+                if verbose: print("Skipping %d tail samples for FFT" % (self._position - max(self._covered, self._next_start)))
+        self._pending = self._pending[..., :0]
+        self._next_start = self._covered = self._position
+
+    def state(self):
+        # Raw (unshifted, linear) partial results that can be combined with 'merge'
+        return (self._cnt, self._sum, self._min, self._max, self._histogram, self._cross, self._argmax, self._argmin)
+
+    def merge(self, state):
+        # States must be merged in stream order for the max/min frame indices to be correct
+        cnt, fft_sum, fft_min, fft_max, histogram, cross, argmax, argmin = state
+        if cnt == 0:
+            return
+        if self._histogram is not None:
+            self._histogram += histogram
+        if self._cross is not None:
+            self._cross += cross
+        self._sum += fft_sum
+        if self._argmax is None:
+            numpy.maximum(self._max, fft_max, out=self._max)
+        else:
+            self._update_extreme(self._max, self._argmax, fft_max, argmax + self._cnt, numpy.greater)
+        if self._min is None:
+            self._min = numpy.array(fft_min, dtype=self._dtype)
+            if self._argmin is not None:
+                self._argmin[:] = argmin + self._cnt
+        elif self._argmin is None:
+            numpy.minimum(self._min, fft_min, out=self._min)
+        else:
+            self._update_extreme(self._min, self._argmin, fft_min, argmin + self._cnt, numpy.less)
+        self._cnt += cnt
+
+    def count(self):
+        return self._cnt
+
+    def num_bins(self):
+        return self._num_bins
+
+    def hop(self):
+        return self._hop
+
+    def output_bins(self):
+        return self._num_out
+
+    def is_real(self):
+        return self._real
+
+    def dtype(self):
+        # Real precision of the results (complex input is processed in its complex counterpart)
+        return self._dtype
+
+    def channels(self):
+        return self._channels
+
+    def _to_output(self, power, log_scale=True):
+        # Raw linear power to a (shifted, unless real) spectrum, in dB if 'log_scale'
+        if self._real:
+            power = power.copy()
         else:
-            fft_min = numpy.minimum(fft, fft_min)
-        fft_max = numpy.maximum(fft, fft_max)
-        
-        # if verbose: 
-        #    print("%d:%d " % (cnt, i),)
-        #    sys.stdout.flush()
-
-        cnt += 1
-    
-    #if verbose: print
-    
-    if cnt > 0:
-        fft_avg = fft_sum / float(cnt)
-    
-    if log_scale:
-        if verbose:
+            power = numpy.fft.fftshift(power, axes=-1)
+        if log_scale:
+            power = (10.0 * numpy.log10(power)) + numpy.asarray(self._adjust_amount, dtype=self._dtype)
+        return power
+
+    def results(self, log_scale=True, verbose=False):
+        if self._cnt == 0:
+            return _empty_results(self._quantiles, self._channels, self._cross_spectra, self._track_max, self._track_min)
+
+        if log_scale and verbose:
             print("Running logarithm...",)
             sys.stdout.flush()
 
-        adjust_amount = 0.0
+        fft_avg = self._to_output(self._sum / self._dtype.type(self._cnt), log_scale)
+        fft_max = self._to_output(self._max, log_scale)
+        fft_min = self._to_output(self._min, log_scale)
+
+        if log_scale and verbose: print("done.")
+
+        results = (self._cnt, fft_avg, fft_min, fft_max)
+        if self._quantiles is not None:
+            results += (self._calc_quantiles(log_scale),)
+        if self._cross is not None:
+            cross = self._cross / self._dtype.type(self._cnt)
+            if not self._real:
+                cross = numpy.fft.fftshift(cross, axes=-1)
+            results += (cross,)
+        for indices in [self._argmax, self._argmin]:
+            if indices is not None:
+                if not self._real:
+                    indices = numpy.fft.fftshift(indices, axes=-1)
+                results += (indices.copy(),)
+
+        return results
+
+# Also averages every 'frames_per_row' consecutive frames into a row of a spectrogram (waterfall).
+# Completed rows (in dB if 'log_scale', as 'row_dtype') are collected with 'rows'.
+class SpectrogramAccumulator(SpectrumAccumulator):
+    def __init__(self, num_bins, frames_per_row=1, log_scale=True, row_dtype=numpy.float32, **kwds):
+        self._frames_per_row = max(1, int(frames_per_row))
+        self._log_scale = log_scale
+        self._row_dtype = row_dtype
+        SpectrumAccumulator.__init__(self, num_bins, **kwds)
+
+    def reset(self):
+        SpectrumAccumulator.reset(self)
+        self._row_sum = numpy.zeros(self._shape, dtype=self._dtype)
+        self._row_cnt = 0
+        self._rows = []
+
+    def _reduce(self, power):
+        SpectrumAccumulator._reduce(self, power)
+        i = 0
+        while i < power.shape[-2]:  # 'power' may straddle rows
+            n = min(power.shape[-2] - i, self._frames_per_row - self._row_cnt)
+            self._row_sum += power[..., i:i+n, :].sum(axis=-2)
+            self._row_cnt += n
+            i += n
+            if self._row_cnt == self._frames_per_row:
+                self.end_row()
+
+    def end_row(self):
+        # Completes the current row, even if it has fewer than 'frames_per_row' frames
+        if self._row_cnt == 0:
+            return
+        row = self._to_output(self._row_sum / self._dtype.type(self._row_cnt), self._log_scale)
+        self._rows += [row.astype(self._row_dtype)]
+        self._row_sum.fill(0)
+        self._row_cnt = 0
+
+    def rows(self):
+        rows = self._rows
+        self._rows = []
+        return rows
+
+    def frames_per_row(self):
+        return self._frames_per_row
+
+# For live displays: keeps an exponential moving average (weight 'alpha' for each new frame) and a peak-hold
+# that decays by 'peak_decay' dB per frame, both updated in one vectorised step per batch of frames.
+# 'get_data' returns the '[average, peak]' series (and 'freqs' the matching X axis) for 'realtime_graph.set_data'.
+# The all-time statistics from 'results' are kept too.
+class LiveSpectrum(SpectrumAccumulator):
+    def __init__(self, num_bins, alpha=0.1, peak_decay=0.1, samp_rate=1.0, freq=0.0, **kwds):
+        self._alpha = float(alpha)
+        self._peak_decay = 10.0 ** (-float(peak_decay) / 10.0) # Linear
+        self._samp_rate = samp_rate
+        self._freq = freq
+        SpectrumAccumulator.__init__(self, num_bins, **kwds)
+
+    def reset(self):
+        SpectrumAccumulator.reset(self)
+        self._average = None
+        self._peak = None
+
+    def _reduce(self, power):
+        SpectrumAccumulator._reduce(self, power)
+
+        if self._average is None:
+            self._average = power[..., 0, :].copy()
+            self._peak = power[..., 0, :].copy()
+            power = power[..., 1:, :]
+        num_frames = power.shape[-2]
+        if num_frames == 0:
+            return
+
+        ages = numpy.arange(num_frames - 1, -1, -1)  # Newest frame has age 0
+        weights = (self._alpha * ((1.0 - self._alpha) ** ages)).astype(self._dtype)
+        self._average *= (1.0 - self._alpha) ** num_frames
+        self._average += numpy.dot(weights, power)  # Sums over the frames axis
+
+        decays = (self._peak_decay ** ages).astype(self._dtype)
+        self._peak *= self._peak_decay ** num_frames
+        numpy.maximum(self._peak, (power * decays[:, numpy.newaxis]).max(axis=-2), out=self._peak)
+
+    def average(self, log_scale=True):
+        if self._average is None:
+            return None
+        return self._to_output(self._average, log_scale)
+
+    def peak(self, log_scale=True):
+        if self._peak is None:
+            return None
+        return self._to_output(self._peak, log_scale)
+
+    def freqs(self):
+        return calc_freqs(self._num_bins, self._samp_rate, self._freq, self._real)
+
+    def get_data(self, log_scale=True):
+        if self._average is None:
+            return []
+        return [self.average(log_scale), self.peak(log_scale)]
+
+def _shift_into(dest, src, real=False):
+    # 'fftshift' without allocating
+    if real:
+        dest[:] = src
+        return
+    n = len(src)
+    s = n // 2
+    dest[:s] = src[n-s:]
+    dest[s:] = src[:n-s]
+
+# Owns every buffer needed to compute 'calc_fft' results for up to 'max_frames' frames at a time,
+# so that repeated calls (e.g. on equally sized buffers in a real-time loop) allocate nothing once warmed up.
+# Results are written into the caller's '(avg, min, max)' arrays ('out'), or into the workspace's own (overwritten by the next call).
+# Allocation-free FFTs need pyfftw, or numpy >= 2 in double precision (scipy allocates its output), and samples of the workspace's precision.
+class SpectrumWorkspace():
+    def __init__(self, num_bins, window=numpy.hamming, step=1, overlap=0.0, hop=None, max_frames=None, adjust=True, ref_scale=2.0, real=False, dtype=numpy.float64, fft_backend=None, fft_workers=None):
+        self._num_bins = num_bins
+        self._window = window
+        self._real = real
+        self._dtype = numpy.finfo(dtype).dtype
+        self._num_out = num_bins
+        if real:
+            self._num_out = (num_bins // 2) + 1
+        self._hop = _calc_hop(num_bins, step, overlap, hop)
+
+        if max_frames is None:
+            max_frames = DEFAULT_CHUNK_SAMPLES // num_bins
+        self._max_frames = max(1, int(max_frames))
+
+        frames_dtype = self._dtype
+        if not real:
+            frames_dtype = numpy.result_type(self._dtype, numpy.complex64)
+        complex_dtype = numpy.result_type(self._dtype, numpy.complex64)
+
+        window_info = get_window(window, num_bins, self._dtype)
+        self._window_points = None
+        if window_info.points is not None:
+            # Same type and shape as the frames: casting or broadcasting would make the ufunc allocate buffers
+            self._window_points = numpy.tile(window_info.points.astype(frames_dtype), (self._max_frames, 1))
+        self._adjust_amount = 0.0
         if adjust:
-            adjust_amount =(-20.0 * math.log10(num_bins)     # Adjust for number of bins
-                            -20.0 * math.log10(ref_scale/2)) # Adjust for reference scale
+            self._adjust_amount = _calc_adjust_amount(window_info, ref_scale)
+            if real:
+                self._adjust_amount = self._adjust_amount + _one_sided_adjust(num_bins, self._dtype)
+
+        self._fft_backend = get_fft_backend(num_bins, self._dtype, real, fft_backend, fft_workers)
+
+        self._frames = numpy.zeros((self._max_frames, num_bins), dtype=frames_dtype)
+        self._fft = numpy.zeros((self._max_frames, self._num_out), dtype=complex_dtype)
+        self._power = numpy.zeros((self._max_frames, self._num_out), dtype=self._dtype)
+        self._sum = numpy.zeros(self._num_out, dtype=self._dtype)
+        self._min = numpy.zeros(self._num_out, dtype=self._dtype)
+        self._max = numpy.zeros(self._num_out, dtype=self._dtype)
+        self._tmp = numpy.zeros(self._num_out, dtype=self._dtype)
+        self._out = (numpy.zeros(self._num_out, dtype=self._dtype), numpy.zeros(self._num_out, dtype=self._dtype), numpy.zeros(self._num_out, dtype=self._dtype))
+
+    def _reduce(self, frames, window_points, first):
+        n = len(frames)
+        buf = self._frames[:n]
+        if len(frames[0]) < self._num_bins:
+            buf[:, len(frames[0]):] = 0 # Zero pad
+            buf = buf[:, :len(frames[0])]
+        numpy.copyto(buf, frames, casting='same_kind')
+        if window_points is not None:
+            buf *= window_points[:n]
+
+        fft = self._fft_backend.fft(self._frames[:n], self._num_bins, self._real, out=self._fft[:n])
+        power = self._power[:n]
+        numpy.absolute(fft, out=power)
+        numpy.square(power, out=power)
 
+        if first:
+            numpy.add.reduce(power, axis=0, out=self._sum)
+            numpy.minimum.reduce(power, axis=0, out=self._min)
+            numpy.maximum.reduce(power, axis=0, out=self._max)
+        else:
+            numpy.add.reduce(power, axis=0, out=self._tmp)
+            self._sum += self._tmp
+            numpy.minimum.reduce(power, axis=0, out=self._tmp)
+            numpy.minimum(self._min, self._tmp, out=self._min)
+            numpy.maximum.reduce(power, axis=0, out=self._tmp)
+            numpy.maximum(self._max, self._tmp, out=self._max)
+
+    def calc_fft(self, samps, out=None, log_scale=True, pad=True):
+        if out is None:
+            out = self._out
+        fft_avg, fft_min, fft_max = out
+
+        num_full, num_tail = _count_frames(len(samps), self._num_bins, self._hop, (pad or len(samps) < self._num_bins))
+        cnt = num_full + num_tail
+        if cnt == 0:
+            return (0, fft_avg, fft_min, fft_max)
+
+        if num_full > 0:
+            frames = _frame_view(samps, self._num_bins, self._hop, num_full)
+            for i in range(0, num_full, self._max_frames):
+                self._reduce(frames[i:i+self._max_frames], self._window_points, (i == 0))
+        if num_tail > 0:
+            tail = samps[num_full*self._hop:]
+            window_points = get_window(self._window, len(tail), self._dtype).points # Shorter window
             if window_points is not None:
-                window_power = sum(map(lambda x: x*x, window_points))
-                adjust_amount += (-10.0 * math.log10(window_power/num_bins)) # Adjust for windowing loss
-        
-        # FIXME  We need to add 3dB to all bins but the DC bin
-        fft_avg = (10.0 * numpy.log10(fft_avg)) + adjust_amount
-        fft_max = (10.0 * numpy.log10(fft_max)) + adjust_amount
-        fft_min = (10.0 * numpy.log10(fft_min)) + adjust_amount
-        
-        if verbose: print("done.")
-    
-    return (cnt, fft_avg, fft_min, fft_max)
+                window_points = window_points[numpy.newaxis, :]
+            self._reduce(tail[numpy.newaxis, :], window_points, (num_full == 0))
+
+        self._sum /= cnt
+        for dest, src in zip(out, [self._sum, self._min, self._max]):
+            if log_scale:
+                numpy.log10(src, out=src)
+                src *= 10.0
+                src += self._adjust_amount
+            _shift_into(dest, src, self._real)
+
+        return (cnt, fft_avg, fft_min, fft_max)
+
+    def num_bins(self):
+        return self._num_bins
+
+    def output_bins(self):
+        return self._num_out
+
+# Assumes normalised input values [-1,1]
+def calc_fft(samps, num_bins=None, log_scale=True, step=1, window=numpy.hamming, pad=True, adjust=True, verbose=False, ref_scale=2.0, chunk_frames=None, overlap=0.0, hop=None, real=False, dtype=numpy.float64, quantiles=None, cross_spectra=False, **kwds):
+    # Frames start every 'hop' samples. If 'hop' is not given, it is 'num_bins * step * (1 - overlap)'
+    # e.g. 'overlap=0.5' for 50% Welch averaging, or 'step=2' to skip every other frame.
+    # 'real' computes one-sided spectra of real-valued input with 'rfft', and 'dtype' sets the precision (see 'SpectrumAccumulator').
+    # With 'quantiles', per-bin quantile spectra are also returned (other keywords configure them, see 'SpectrumAccumulator').
+    # A 2D 'samps' is treated as '(channels, samples)': results are per channel, and 'cross_spectra' adds the cross-spectral matrix.
+    # 'track_max' and 'track_min' add the index of the frame holding each bin's max and min (sample offset 'index * hop').
+    samps = numpy.asarray(samps)
+    channels = None
+    if samps.ndim > 1:
+        channels = samps.shape[0]
+
+    if samps.shape[-1] == 0:
+        return _empty_results(quantiles, channels, cross_spectra, kwds.get('track_max', False), kwds.get('track_min', False))
+
+    if num_bins is None:
+        num_bins = samps.shape[-1]
+
+    accumulator = SpectrumAccumulator(num_bins, step=step, window=window, overlap=overlap, hop=hop, chunk_frames=chunk_frames, adjust=adjust, ref_scale=ref_scale, real=real, dtype=dtype, quantiles=quantiles, channels=channels, cross_spectra=cross_spectra, **kwds)
+    accumulator.add(samps)
+    accumulator.flush(pad=(pad or accumulator.count() == 0), verbose=verbose)   # If less 'samps' than 'num_bins', will always zero pad
+    if verbose: print("Processed %d FFTs" % (accumulator.count()))
+
+    return accumulator.results(log_scale=log_scale, verbose=verbose)
+
+def _open_source(source):
+    # 'source' is a path, a list of paths (read as one 'MultiInputFile'), an 'InputFile' or a 'MultiInputFile'
+    if isinstance(source, (input_file.InputFile, input_file.MultiInputFile)):
+        return source
+    if isinstance(source, (list, tuple)):
+        return input_file.MultiInputFile(source)
+    return input_file.InputFile(source)
+
+def _input_file_args(f):
+    # Enough to re-open 'f' in another process: (class, arguments)
+    if isinstance(f, input_file.MultiInputFile):
+        return (input_file.MultiInputFile, f.args())
+    return (input_file.InputFile, (f.path(), f.format(), f.sample_rate(), f.freq()))
+
+def _time_to_sample(f, t):
+    # 't' is a 'datetime' (looked up in the file's timing, see 'InputFile.time_sample'), or seconds from the start of the file
+    if isinstance(t, datetime.datetime):
+        return f.time_sample(t)
+    if f.sample_rate() is None:
+        raise Exception("Sample rate of {} is unknown".format(f.path()))
+    return int(round(t * f.sample_rate()))
+
+def _sample_range(f, start=0, length=None, start_time=None, end_time=None):
+    if start_time is not None:
+        start = _time_to_sample(f, start_time)
+    if end_time is not None:
+        length = _time_to_sample(f, end_time) - start
+    start = max(0, start)
+    if length is None:
+        length = f.samples() - start
+    length = max(0, min(length, f.samples() - start))
+    return (start, length)
+
+def _count_frames(length, num_bins, hop, pad=True):
+    # Number of frames that framing 'length' samples will produce: (full frames, padded tail frames)
+    num_full = 0
+    if length >= num_bins:
+        num_full = 1 + ((length - num_bins) // hop)
+    covered = 0
+    if num_full > 0:
+        covered = ((num_full - 1) * hop) + num_bins
+    num_tail = 0
+    if pad and (num_full * hop) < length and covered < length:  # As 'SpectrumAccumulator.flush': not when the tail falls in the gap after the last frame
+        num_tail = 1
+    return (num_full, num_tail)
+
+def _read_file_blocks(f, start, length, block_samples=DEFAULT_BLOCK_SAMPLES, dtype=numpy.complex64):
+    # Read ahead on another thread while the blocks are processed (each block is only valid until the next is requested)
+    return f.iter_blocks(block_samples, start=start, length=length, dtype=dtype)
+
+def _block_dtype(accumulator):
+    # A real accumulator (e.g. for mono audio) needs real samples, others are given complex samples
+    if accumulator.is_real():
+        return accumulator.dtype()
+    return numpy.complex64
+
+def _accumulate_file(accumulator, f, start, length, block_samples=DEFAULT_BLOCK_SAMPLES):
+    for samps in _read_file_blocks(f, start, length, block_samples, _block_dtype(accumulator)):
+        accumulator.add(samps)
+
+def _calc_fft_segment(args):
+    (file_type, file_args), start, length, flush, pad, block_samples, accumulator_kwds = args
+    f = file_type(*file_args)
+    accumulator = SpectrumAccumulator(**accumulator_kwds)
+    _accumulate_file(accumulator, f, start, length, block_samples)
+    if flush:
+        accumulator.flush(pad=(pad or accumulator.count() == 0))
+    return accumulator.state()
+
+# Same as 'calc_fft', but for samples in a file ('source' as for 'calc_fft_file') split across 'processes' worker processes.
+# Each worker reads its own frame-aligned segment of the file, so no samples are passed between processes.
+# The sample range is the same as for 'calc_fft_file'. Other keywords are passed to 'SpectrumAccumulator'.
+def calc_fft_parallel(source, num_bins, processes=None, start=0, length=None, start_time=None, end_time=None, pad=True, log_scale=True, verbose=False, block_samples=DEFAULT_BLOCK_SAMPLES, segments=None, **kwds):
+    f = _open_source(source)
+    file_args = _input_file_args(f)
+
+    start, length = _sample_range(f, start, length, start_time, end_time)
+
+    kwds['num_bins'] = num_bins
+    kwds.setdefault('fft_workers', 1)   # Parallelism comes from the processes
+    accumulator = SpectrumAccumulator(**kwds)
+    hop = accumulator.hop()
+
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    if segments is None:
+        segments = processes
+
+    num_full, num_tail = _count_frames(length, num_bins, hop)
+    segments = max(1, min(segments, num_full))
+
+    jobs = []
+    first_frame = 0
+    for i in range(segments):
+        last_frame = (num_full * (i + 1)) // segments
+        segment_start = start + (first_frame * hop)
+        if i == (segments - 1):
+            segment_length = length - (first_frame * hop) # Last segment also gets the tail
+        else:
+            segment_length = ((last_frame - first_frame - 1) * hop) + num_bins
+        jobs += [(file_args, segment_start, segment_length, (i == (segments - 1)), pad, block_samples, kwds)]
+        first_frame = last_frame
+
+    if verbose: print("Processing %d frames in %d segments with %d processes" % (num_full, len(jobs), processes))
+
+    if processes > 1 and len(jobs) > 1:
+        pool = multiprocessing.Pool(processes)
+        try:
+            states = pool.map(_calc_fft_segment, jobs)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        states = map(_calc_fft_segment, jobs)
+
+    for state in states:
+        accumulator.merge(state)
+
+    if verbose: print("Processed %d FFTs" % (accumulator.count()))
+
+    return accumulator.results(log_scale=log_scale, verbose=verbose)
+
+# Same as 'calc_fft', but streams the samples from a file 'block_samples' at a time ('source' is a path or an 'InputFile',
+# or a list of paths or a 'MultiInputFile' for a recording split across files),
+# so memory use does not depend on the length of the recording.
+# The range is given by 'start' and 'length' in samples, or 'start_time' and 'end_time' (a 'datetime', or seconds from the start of the file).
+# Other keywords are passed to 'SpectrumAccumulator'.
+def calc_fft_file(source, num_bins, start=0, length=None, start_time=None, end_time=None, pad=True, log_scale=True, verbose=False, block_samples=DEFAULT_BLOCK_SAMPLES, **kwds):
+    f = _open_source(source)
+
+    start, length = _sample_range(f, start, length, start_time, end_time)
+    if verbose: print("Processing %d samples from %d in %s" % (length, start, f.path()))
+
+    accumulator = SpectrumAccumulator(num_bins, **kwds)
+    _accumulate_file(accumulator, f, start, length, block_samples)
+    accumulator.flush(pad=(pad or accumulator.count() == 0), verbose=verbose)
+    if verbose: print("Processed %d FFTs" % (accumulator.count()))
+
+    return accumulator.results(log_scale=log_scale, verbose=verbose)
+
+def _iter_rows(accumulator, blocks, pad=False, partial=True):
+    for samps in blocks:
+        accumulator.add(samps)
+        for row in accumulator.rows():
+            yield row
+    accumulator.flush(pad=pad)
+    if partial:
+        accumulator.end_row()
+    for row in accumulator.rows():
+        yield row
+
+# Yields a spectrogram (waterfall) row, the average of each 'frames_per_row' frames, as sample chunks from 'blocks' are processed.
+# The tail is padded into a final frame if 'pad', and a final row with fewer frames is yielded if 'partial'.
+# Other keywords are passed to 'SpectrogramAccumulator' (and on to 'SpectrumAccumulator').
+def iter_waterfall(blocks, num_bins, frames_per_row, pad=False, partial=True, **kwds):
+    accumulator = SpectrogramAccumulator(num_bins, frames_per_row, **kwds)
+    for row in _iter_rows(accumulator, blocks, pad, partial):
+        yield row
+
+# Same as 'iter_waterfall', for a range of samples in a file (see 'calc_fft_file')
+def iter_waterfall_file(source, num_bins, frames_per_row, start=0, length=None, start_time=None, end_time=None, pad=False, partial=True, block_samples=DEFAULT_BLOCK_SAMPLES, **kwds):
+    f = _open_source(source)
+
+    start, length = _sample_range(f, start, length, start_time, end_time)
+    accumulator = SpectrogramAccumulator(num_bins, frames_per_row, **kwds)
+    for row in _iter_rows(accumulator, _read_file_blocks(f, start, length, block_samples, _block_dtype(accumulator)), pad, partial):
+        yield row
+
+# Writes the waterfall of a range of samples in a file (see 'iter_waterfall_file') to 'output_path', one row at a time.
+# The file starts with a line of JSON describing the waterfall, padded to 'WATERFALL_HEADER_ALIGN' bytes,
+# followed by the rows as a 2D float32 array. Use 'read_waterfall' to memory-map it.
+def write_waterfall(source, output_path, num_bins, frames_per_row, start=0, length=None, start_time=None, end_time=None, pad=False, partial=True, block_samples=DEFAULT_BLOCK_SAMPLES, verbose=False, **kwds):
+    f = _open_source(source)
+
+    start, length = _sample_range(f, start, length, start_time, end_time)
+
+    kwds['row_dtype'] = numpy.float32
+    accumulator = SpectrogramAccumulator(num_bins, frames_per_row, **kwds)
+
+    num_full, num_tail = _count_frames(length, num_bins, accumulator.hop(), pad)
+    num_frames = num_full + num_tail
+    num_rows = num_frames // accumulator.frames_per_row()
+    if partial and (num_frames % accumulator.frames_per_row()) > 0:
+        num_rows += 1
+    num_cols = accumulator.output_bins()
+
+    time_start = f.sample_time(start)   # Follows drops in a timing file and gaps between files
+    if time_start is not None:
+        time_start = str(time_start)
+    row_interval = None
+    if f.sample_rate():
+        row_interval = 1. * accumulator.frames_per_row() * accumulator.hop() / f.sample_rate()
+
+    header = {
+        'source': f.path(),
+        'freq': f.freq(),
+        'samp_rate': f.sample_rate(),
+        'time_start': time_start,
+        'start': start,
+        'length': length,
+        'num_bins': num_bins,
+        'hop': accumulator.hop(),
+        'frames_per_row': accumulator.frames_per_row(),
+        'row_interval': row_interval,
+        'real': accumulator.is_real(),
+        'log_scale': kwds.get('log_scale', True),
+        'rows': num_rows,
+        'cols': num_cols,
+        'dtype': numpy.dtype(numpy.float32).str,
+    }
+    text = json.dumps(header)
+    header_size = ((len(text) + 1 + WATERFALL_HEADER_ALIGN - 1) // WATERFALL_HEADER_ALIGN) * WATERFALL_HEADER_ALIGN  # Including the newline
+
+    if verbose: print("Writing %d x %d waterfall to %s" % (num_rows, num_cols, output_path))
+
+    with open(output_path, 'wb') as out:
+        out.write((text.ljust(header_size - 1) + '\n').encode('ascii'))
+        out.truncate(header_size + (num_rows * num_cols * 4))  # Sparse until the rows are written
+
+    if num_rows == 0:
+        return header
+
+    data = numpy.memmap(output_path, dtype=numpy.float32, mode='r+', offset=header_size, shape=(num_rows, num_cols))
+    idx = 0
+    for row in _iter_rows(accumulator, _read_file_blocks(f, start, length, block_samples, _block_dtype(accumulator)), pad, partial):
+        data[idx] = row
+        idx += 1
+    data.flush()
+    del data
+
+    if verbose: print("Wrote %d rows" % (idx))
+
+    return header
+
+# Returns the header and a read-only memory-mapped (rows, cols) array of a file written by 'write_waterfall'
+def read_waterfall(path):
+    with open(path, 'rb') as f:
+        header = json.loads(f.readline().decode('ascii'))
+        header_size = f.tell()  # The header line is padded up to the rows
+    if header['rows'] == 0:
+        return (header, numpy.zeros((0, header['cols']), dtype=header['dtype']))
+    data = numpy.memmap(path, dtype=header['dtype'], mode='r', offset=header_size, shape=(header['rows'], header['cols']))
+    return (header, data)
+
+def _lowpass_taps(num_taps, cutoff):
+    # Windowed-sinc low-pass filter with unity DC gain ('cutoff' in cycles per sample)
+    n = numpy.arange(num_taps) - ((num_taps - 1) / 2.0)
+    taps = 2.0 * cutoff * numpy.sinc(2.0 * cutoff * n) * numpy.hamming(num_taps)
+    return taps / numpy.sum(taps)
+
+# Mixes 'offset' Hz down to baseband and decimates by 'decimation' with a low-pass FIR filter that passes 'bandwidth' Hz.
+# By default the output rate is at least 'ZOOM_OVERSAMPLE' times the bandwidth, and the filter's cutoff is half the output rate,
+# so the band is flat and what aliases into the output lands outside it (only the middle 'bandwidth' Hz of the output is clean).
+# Only every 'decimation'-th output is computed (as a polyphase filter would), from a strided view of the input.
+# The mixer phase and filter history carry over between calls to 'process', so a stream can be fed in chunks of any size.
+class ZoomDecimator():
+    def __init__(self, samp_rate, offset, bandwidth, decimation=None, taps_per_phase=ZOOM_TAPS_PER_PHASE, dtype=numpy.complex128):
+        if decimation is None:
+            decimation = max(1, int(samp_rate // (ZOOM_OVERSAMPLE * bandwidth)))
+        self._decimation = int(decimation)
+        self._samp_rate = float(samp_rate)
+        self._offset = float(offset)
+        self._bandwidth = float(bandwidth)
+        self._dtype = numpy.result_type(dtype, numpy.complex64)
+
+        num_taps = (taps_per_phase * self._decimation) + 1
+        cutoff = 0.5 * max(self.output_rate(), self._bandwidth)   # Transition band centred between the band edge and its alias
+        self._taps = _lowpass_taps(num_taps, min(0.5, cutoff / self._samp_rate))[::-1].astype(self._dtype) # Reversed for dot products
+
+        self._phase_step = self._offset / self._samp_rate    # Cycles per sample
+        self.reset()
+
+    def reset(self):
+        self._history = numpy.zeros(len(self._taps) - 1, dtype=self._dtype)   # Last input samples (zeros before the start)
+        self._position = 0  # Absolute index of the next input sample
+        self._next_output = 0   # Absolute index of the input sample aligned with the next output
+
+    def output_rate(self):
+        return self._samp_rate / self._decimation
+
+    def decimation(self):
+        return self._decimation
+
+    def bandwidth(self):
+        return self._bandwidth
+
+    def process(self, samps):
+        samps = numpy.asarray(samps)
+        phase = numpy.mod(self._phase_step * self._position, 1.0) + (self._phase_step * numpy.arange(len(samps)))
+        mixed = samps * numpy.exp(-2j * numpy.pi * phase).astype(self._dtype)
+
+        buf = numpy.concatenate((self._history, mixed.astype(self._dtype, copy=False)))
+        buf_idx = self._position - len(self._history)
+        self._position += len(samps)
+        self._history = buf[len(buf)-len(self._history):]
+
+        first = self._next_output - buf_idx - (len(self._taps) - 1)   # Start of the first output's window in 'buf'
+        if first + len(self._taps) > len(buf):
+            return numpy.zeros(0, dtype=self._dtype)
+        num_out = 1 + ((len(buf) - first - len(self._taps)) // self._decimation)
+        self._next_output += num_out * self._decimation
+
+        windows = _frame_view(buf[first:], len(self._taps), self._decimation, num_out)
+        return numpy.dot(windows, self._taps)
+
+def _zoom_offset(center, freq):
+    if freq is None:
+        freq = 0.0
+    return center - freq
+
+# Spectrum of just the band of 'bandwidth' Hz around 'center' (absolute, given the centre frequency 'freq' of 'samps'):
+# the band is mixed to baseband and decimated (see 'ZoomDecimator') in chunks, then framed into 'num_bins' FFTs,
+# so resolution is 'samp_rate / (decimation * num_bins)' and the FFT work scales with the zoomed bandwidth.
+# Returns the usual results of 'calc_fft' and the frequency of each bin, trimmed to the bins within the band
+# (about 'num_bins / ZOOM_OVERSAMPLE' of them with the default decimation).
+def calc_zoom_fft(samps, samp_rate, center, bandwidth, num_bins, freq=0.0, decimation=None, taps_per_phase=ZOOM_TAPS_PER_PHASE, pad=True, log_scale=True, verbose=False, block_samples=DEFAULT_BLOCK_SAMPLES, **kwds):
+    return _calc_zoom_fft([samps[i:i+block_samples] for i in range(0, len(samps), block_samples)], samp_rate, center, bandwidth, num_bins, freq, decimation, taps_per_phase, pad, log_scale, verbose, kwds)
+
+# Same as 'calc_zoom_fft' for a range of samples in a file (see 'calc_fft_file')
+def calc_zoom_fft_file(source, center, bandwidth, num_bins, start=0, length=None, start_time=None, end_time=None, decimation=None, taps_per_phase=ZOOM_TAPS_PER_PHASE, pad=True, log_scale=True, verbose=False, block_samples=DEFAULT_BLOCK_SAMPLES, **kwds):
+    f = _open_source(source)
+
+    start, length = _sample_range(f, start, length, start_time, end_time)
+    return _calc_zoom_fft(_read_file_blocks(f, start, length, block_samples), f.sample_rate(), center, bandwidth, num_bins, f.freq(), decimation, taps_per_phase, pad, log_scale, verbose, kwds)
+
+def _calc_zoom_fft(blocks, samp_rate, center, bandwidth, num_bins, freq, decimation, taps_per_phase, pad, log_scale, verbose, kwds):
+    decimator = ZoomDecimator(samp_rate, _zoom_offset(center, freq), bandwidth, decimation, taps_per_phase, kwds.get('dtype', numpy.float64))
+    if verbose: print("Zooming to %f Hz wide around %f Hz: decimation %d to %f sps" % (bandwidth, center, decimator.decimation(), decimator.output_rate()))
+
+    accumulator = SpectrumAccumulator(num_bins, **kwds)
+    for samps in blocks:
+        accumulator.add(decimator.process(samps))
+    accumulator.flush(pad=(pad or accumulator.count() == 0), verbose=verbose)
+    if verbose: print("Processed %d FFTs" % (accumulator.count()))
+
+    freqs = calc_freqs(num_bins, decimator.output_rate(), center)
+    first = numpy.searchsorted(freqs, center - (bandwidth / 2.0), side='left')
+    last = numpy.searchsorted(freqs, center + (bandwidth / 2.0), side='right')
+    results = accumulator.results(log_scale=log_scale, verbose=verbose)
+    results = tuple([results[0]] + [x[..., first:last] for x in results[1:]])    # Every result has bins along the last axis
+
+    return (results, freqs[first:last])
@@ -18,12 +18,277 @@
 # Boston, MA 02110-1301, USA.
 # 
 
-import os, struct, datetime
+import os, struct, datetime, threading, bisect, collections, math, re, json
 import numpy
 
+try:
+	import queue
+except ImportError:
+	import Queue as queue
+
+PREFETCH_BLOCKS = 2 # Blocks read ahead by 'iter_blocks'
+MAX_OPEN_SEGMENTS = 16 # Files kept open by a 'MultiInputFile'
+TIMING_EXTENSION = ".timing" # Appended to a recording's path to find its timing file
+TIMING_TIME_FORMATS = ["%Y-%m-%dT%H:%M:%S.%f", "%Y-%m-%dT%H:%M:%S"]
+SIGMF_META_EXTENSION = ".sigmf-meta"
+SIGMF_DATA_EXTENSION = ".sigmf-data"
+
+WAVE_FORMAT_PCM = 1
+WAVE_FORMAT_IEEE_FLOAT = 3
+WAVE_FORMAT_EXTENSIBLE = 0xFFFE
+_WAVE_FORMATS = {   # (format, bits per sample): component format (24-bit samples are packed, and read as 'V3')
+	(WAVE_FORMAT_PCM, 8): 'u1',
+	(WAVE_FORMAT_PCM, 16): '<i2',
+	(WAVE_FORMAT_PCM, 24): 'V3',
+	(WAVE_FORMAT_PCM, 32): '<i4',
+	(WAVE_FORMAT_IEEE_FLOAT, 32): '<f4',
+	(WAVE_FORMAT_IEEE_FLOAT, 64): '<f8',
+}
+
+def _sigmf_format(datatype):
+	# (component format, components per sample) of a SigMF 'core:datatype' (e.g. 'ci16_le', 'cf32_le', 'ru8')
+	match = re.match(r"^([rc])([fiu])(\d+)(_le|_be)?$", datatype)
+	if match is None:
+		raise Exception("Unknown SigMF datatype: {}".format(datatype))
+	sample_type, kind, bits, endian = match.groups()
+	bits = int(bits)
+	byte_order = {"_le": "<", "_be": ">", None: "|"}[endian]
+	if sample_type == "c" and kind == "f":
+		return (numpy.dtype("{}c{}".format(byte_order, (2 * bits) // 8)), 1)   # Native complex
+	item_format = numpy.dtype("{}{}{}".format(byte_order, kind, bits // 8))
+	if sample_type == "c":
+		return (item_format, 2)
+	return (item_format, 1)
+
+def _parse_sigmf_time(value):
+	# ISO 8601 UTC (e.g. '2020-01-01T12:00:00.123456789Z'), with the fraction cut to microseconds
+	value = value.rstrip("Z")
+	if "." in value:
+		value, fraction = value.split(".", 1)
+		value += "." + fraction[:6]
+	return _parse_time(value)
+
+def _ceil_samples(seconds, samp_rate):
+	# Samples in 'seconds', rounded up (ignoring floating-point error)
+	return int(math.ceil(round(seconds * samp_rate, 6)))
+
+def _parse_time(value):
+	# Seconds since the Unix epoch (as local time, like file modification times), or an ISO 8601 local time
+	try:
+		return datetime.datetime.fromtimestamp(float(value))
+	except ValueError:
+		pass
+	for time_format in TIMING_TIME_FORMATS:
+		try:
+			return datetime.datetime.strptime(value, time_format)
+		except ValueError:
+			pass
+	raise Exception("Cannot parse time: {}".format(value))
+
+# A timing file is text, with one entry per line: '<sample index> <time> [<frequency in Hz>]' ('#' starts a comment).
+# Each entry gives the time at which a sample was recorded (and the frequency from then on, after a retune).
+# Samples between entries follow at the sample rate, so an entry whose time jumps ahead marks dropped samples.
+# Returns (sample indices, times, frequencies (NaN where not given)), sorted by sample index.
+def read_timing_file(path):
+	entries = []
+	with open(path) as f:
+		for line_number, line in enumerate(f):
+			line = line.split("#", 1)[0].split()
+			if len(line) == 0:
+				continue
+			if len(line) not in [2, 3]:
+				raise Exception("{}:{}: expected '<sample> <time> [<frequency>]'".format(path, line_number + 1))
+			freq = float('nan')
+			if len(line) == 3:
+				freq = float(line[2])
+			entries += [(int(line[0]), _parse_time(line[1]), freq)]
+	entries.sort(key=lambda entry: entry[0])
+	samples = numpy.array([entry[0] for entry in entries], dtype=numpy.int64)
+	times = [entry[1] for entry in entries]
+	freqs = numpy.array([entry[2] for entry in entries], dtype=numpy.float64)
+	return (samples, times, freqs)
+
+def write_timing_file(path, entries):
+	# 'entries' is a sequence of (sample index, 'datetime', frequency or None)
+	with open(path, 'w') as f:
+		for sample, t, freq in entries:
+			line = "{} {}".format(int(sample), t.strftime(TIMING_TIME_FORMATS[0]))
+			if freq is not None:
+				line += " {!r}".format(float(freq))
+			f.write(line + "\n")
+
+def _normalisation(item_format):
+	# (offset, scale) that map stored integer components to [-1,1]
+	if item_format.kind == 'u':
+		half = 2 ** ((8 * item_format.itemsize) - 1)
+		return (float(half), 1.0 / half)
+	if item_format.kind in ['i', 'V']:   # 'V3' is packed 24-bit
+		return (0.0, 1.0 / (2 ** ((8 * item_format.itemsize) - 1)))
+	return (0.0, 1.0)
+
+def _unpack_int24(raw):
+	# Packed little-endian 24-bit integers (stored as 'V3') as int32.
+	# Sample 'i' is the top three bytes of the 32-bit word that starts one byte before it, so all but the first are
+	# read through one overlapping strided view of the bytes (and the arithmetic shift extends the sign).
+	data = numpy.ascontiguousarray(raw).view(numpy.uint8).reshape(-1)
+	n = len(data) // 3
+	values = numpy.empty(n, dtype=numpy.int32)
+	if n > 1:
+		words = numpy.ndarray((n - 1,), dtype='<i4', buffer=data, offset=2, strides=(3,))
+		numpy.right_shift(words, 8, out=values[1:])
+	if n > 0:
+		first = int(data[0]) | (int(data[1]) << 8) | (int(data[2]) << 16)
+		if first & 0x800000:
+			first -= (1 << 24)
+		values[0] = first
+	return values
+
+def _convert_into(dest, raw, item_format, normalise=True):
+	# Converts stored items 'raw' (shaped like 'InputFile.memmap') into 'dest' (same length) without allocating, except to unpack 24-bit samples.
+	# For a complex 'dest', the components of real formats become the real and imaginary parts (scaled to [-1,1] if 'normalise'),
+	# and a real floating-point 'dest' takes real samples the same way. Other types of 'dest' get the items as stored
+	# (24-bit samples unpacked into integers), and must have the shape of 'raw'.
+	if (dest.dtype == item_format and dest.shape == raw.shape) or not numpy.issubdtype(dest.dtype, numpy.inexact):
+		if dest.shape != raw.shape:
+			raise Exception("Items of shape {} cannot be converted to {} of shape {}".format(raw.shape[1:], dest.dtype, dest.shape[1:]))
+		if item_format.kind == 'V' and dest.dtype.kind != 'V':
+			raw = _unpack_int24(raw).reshape(raw.shape)
+		numpy.copyto(dest, raw, casting='unsafe')   # As stored
+		return
+	if not numpy.iscomplexobj(dest) and (item_format.kind == 'c' or raw.ndim > 1):
+		raise Exception("Complex samples cannot be converted to {}".format(dest.dtype))
+	if item_format.kind == 'c':
+		numpy.copyto(dest, raw, casting='unsafe')   # Complex to complex
+		return
+	if item_format.kind == 'V':
+		raw = _unpack_int24(raw).reshape(raw.shape)
+	parts = dest
+	if numpy.iscomplexobj(dest):
+		parts = dest.view(numpy.finfo(dest.dtype).dtype).reshape(len(dest), 2)
+		if raw.ndim == 1:   # Real samples
+			parts[:, 1] = 0
+			parts = parts[:, 0]
+	offset, scale = 0.0, 1.0
+	if normalise:
+		offset, scale = _normalisation(item_format)
+	if offset != 0:
+		numpy.subtract(raw, offset, out=parts, casting='unsafe')
+		parts *= scale
+	else:
+		numpy.multiply(raw, scale, out=parts, casting='unsafe')
+
+def _to_samples(data, item_format, item_factor, normalise=True):
+	# Stored complex values are returned as they are, other formats are converted to complex64 (see '_convert_into')
+	item_size = item_format.itemsize * item_factor
+	data = data[:len(data) - (len(data) % item_size)] # Drop a partial item at the end of the file
+	raw = numpy.frombuffer(data, dtype=item_format)
+	if item_format.kind == 'c':
+		return raw
+	if item_factor > 1:
+		raw = raw.reshape(-1, item_factor)
+	samps = numpy.empty(len(raw), dtype=numpy.complex64)
+	_convert_into(samps, raw, item_format, normalise)
+	return samps
+
+def _read_ahead(f, free, full, stop, step_bytes, first_bytes, length_bytes):
+	# Runs on the 'iter_blocks' thread: fills buffers from 'free' and passes them on to 'full', followed by None (or the exception raised)
+	try:
+		block_bytes = first_bytes
+		while length_bytes > 0 and not stop.is_set():
+			buf = free.get()
+			if buf is None: # Stopped
+				break
+			view = memoryview(buf)[:min(block_bytes, length_bytes)]
+			num_read = 0
+			while num_read < len(view):
+				n = f.readinto(view[num_read:])
+				if not n:
+					break
+				num_read += n
+			if num_read == 0:
+				break
+			full.put((buf, num_read))
+			length_bytes -= num_read
+			if num_read < len(view):
+				break
+			block_bytes = step_bytes
+		full.put(None)
+	except Exception as e:
+		full.put(e)
+
+def _clip_range(samples, start=0, length=None):
+	start = max(0, min(start, samples))
+	if length is None:
+		length = samples - start
+	length = max(0, min(length, samples - start))
+	return (start, length)
+
+def _iter_blocks(f, item_format, item_factor, length, block_samples, overlap=0, dtype=numpy.complex64, prefetch=PREFETCH_BLOCKS, normalise=True):
+	# Does the work of 'InputFile.iter_blocks', reading 'length' samples from 'f' (anything with 'readinto' and 'close', closed at the end)
+	if overlap < 0 or overlap >= block_samples:
+		f.close()
+		raise Exception("Overlap {} must be less than the block size {}".format(overlap, block_samples))
+
+	item_size = item_format.itemsize * item_factor
+	item_shape = ()
+	if item_factor > 1:
+		item_shape = (item_factor,)
+	block_shape = (block_samples,)
+	if dtype is None:
+		dtype = item_format
+		block_shape += item_shape
+	elif not numpy.issubdtype(dtype, numpy.inexact):  # Integer items are not scaled, and are shaped like 'memmap' too
+		block_shape += item_shape
+	step = block_samples - overlap
+
+	free = queue.Queue()
+	full = queue.Queue()
+	for i in range(prefetch + 1):
+		free.put(bytearray(block_samples * item_size))
+	stop = threading.Event()
+	thread = threading.Thread(target=_read_ahead, args=(f, free, full, stop, step * item_size, block_samples * item_size, length * item_size))
+	thread.daemon = True
+	thread.start()
+
+	blocks = [numpy.zeros(block_shape, dtype=dtype) for i in range(2)]  # Alternate, so the overlap can be copied from the previous block
+	block = None
+	try:
+		while True:
+			item = full.get()
+			if item is None:
+				break
+			if isinstance(item, Exception):
+				raise item
+			buf, num_read = item
+			num_samples = num_read // item_size # Drops a partial item at the end of the file
+			raw = numpy.frombuffer(buf, dtype=item_format, count=(num_samples * item_factor)).reshape((num_samples,) + item_shape)
+
+			head = 0
+			if block is not None:
+				head = overlap
+			dest = blocks[0]
+			if head > 0:
+				dest[:head] = block[-head:]
+			_convert_into(dest[head:head+num_samples], raw, item_format, normalise)
+			free.put(buf)
+
+			block = dest[:head+num_samples]
+			blocks.reverse()
+			if num_samples > 0:
+				yield block
+			if head + num_samples < block_samples:
+				break
+	finally:
+		stop.set()
+		free.put(None)  # Wake the thread if it is waiting for a buffer
+		thread.join()
+		f.close()
+
 class InputFile():
-	def __init__(self, path, format_hint=None, samp_rate_hint=None, freq_hint=None):
+	def __init__(self, path, format_hint=None, samp_rate_hint=None, freq_hint=None, timing_path=None):
+		# 'timing_path' is the timing file (see 'read_timing_file'), by default the recording's path plus 'TIMING_EXTENSION' if it exists
 		self._path = path
+		self._timing_path = timing_path
 		self._format_hint = format_hint
 		self._samp_rate_hint = samp_rate_hint
 		self._freq_hint = freq_hint
@@ -39,19 +304,31 @@ class InputFile():
 		self._time_start = None
 		self._time_end = None
 		self._file_type = None
+		self._timing = None # (sample indices, seconds after the first entry's time, time of the first entry, frequencies)
 
 		self._open()
 
 	def _open(self):
+		sigmf_meta = None
+		base, extension = os.path.splitext(self._path)
+		if extension in [SIGMF_META_EXTENSION, SIGMF_DATA_EXTENSION]:
+			sigmf_meta = base + SIGMF_META_EXTENSION
+			self._path = base + SIGMF_DATA_EXTENSION
+
 		fileinfo = os.stat(self._path)
 
 		manual_end_time = False
 		manual_start_time = False
+		item_factor = None
+		data_size = None
 
 		with open(self._path, 'rb') as f:
 			RIFF = f.read(4)
-			if RIFF == "RIFF":
-				self._file_type = RIFF
+			if sigmf_meta is not None:
+				item_factor = self._open_sigmf(sigmf_meta)
+				manual_end_time = True
+			elif RIFF == b"RIFF":
+				self._file_type = "RIFF"
 
 				self._freq = self._freq_hint
 
@@ -60,34 +337,39 @@ class InputFile():
 				# FIXME: Check riff_size
 				WAVE = f.read(4)
 				# print WAVE
-				if WAVE == "WAVE":
-					self._file_type = WAVE
+				if WAVE == b"WAVE":
+					self._file_type = "WAVE"
 
 					while True:
-						chunk_id = f.read(4)
-						if chunk_id == "":
+						chunk_header = f.read(8)
+						if len(chunk_header) < 8:
 							break
-						chunk_size, = struct.unpack("<I", f.read(4))
+						chunk_id, chunk_size = struct.unpack("<4sI", chunk_header)
 						# print chunk_id, chunk_size, hex(chunk_size)
 						file_pos = f.tell()
 
-						if chunk_id == "fmt ":
+						if chunk_id == b"fmt ":
 							WAVEFORMATEX_format = "<HHIIHH"
 							WAVEFORMATEX_size = struct.calcsize(WAVEFORMATEX_format)
 							format, channels, samples_per_sec, avg_bytes_per_sec, block_align, bits_per_sample = struct.unpack(WAVEFORMATEX_format, f.read(WAVEFORMATEX_size))
 							# print "format: {}, channels: {}, samples_per_sec: {}, avg_bytes_per_sec: {}, block_align: {}, bits_per_sample: {}".format(format, channels, samples_per_sec, avg_bytes_per_sec, block_align, bits_per_sample)
 
-							assert(format == 1)
-							assert(channels == 2)
+							if format == WAVE_FORMAT_EXTENSIBLE and chunk_size >= 40:
+								cb_size, valid_bits_per_sample, channel_mask = struct.unpack("<HHI", f.read(8))
+								format, = struct.unpack("<H", f.read(2)) # Start of the sub-format GUID
 
-							self._samp_rate = samples_per_sec
+							if channels not in [1, 2]: # Real, or I/Q
+								raise Exception("Unhandled number of channels: {}".format(channels))
+							if (format, bits_per_sample) not in _WAVE_FORMATS:
+								raise Exception("Unhandled format {} with bits-per-sample: {}".format(format, bits_per_sample))
+							if block_align != (channels * ((bits_per_sample + 7) // 8)):
+								raise Exception("Unhandled block alignment: {}".format(block_align))
 
-							if bits_per_sample == 16:
-								self._format = numpy.dtype('i2') # FIXME: Why doesn't int16 work here? (.itemsize)
-							else:
-								raise Exception("Unhandled bits-per-sample: {}".format(bits_per_sample))
+							self._samp_rate = samples_per_sec
+							self._format = numpy.dtype(_WAVE_FORMATS[(format, bits_per_sample)])
+							item_factor = channels
 
-						elif chunk_id == "auxi":
+						elif chunk_id == b"auxi":
 							SYSTEMTIME_format = "<HHHHHHHH" # year, month, day_of_week, day, hour, minute, second, millisecond
 							SYSTEMTIME_size = struct.calcsize(SYSTEMTIME_format)
 							time_start = struct.unpack(SYSTEMTIME_format, f.read(SYSTEMTIME_size))
@@ -106,14 +388,15 @@ class InputFile():
 							self._time_start = datetime.datetime(time_start[0], time_start[1], time_start[3], time_start[4], time_start[5], time_start[6], 1000 * time_start[7])
 							self._time_end = datetime.datetime(time_end[0], time_end[1], time_end[3], time_end[4], time_end[5], time_end[6], 1000 * time_end[7])
 
-						elif chunk_id == "data":
+						elif chunk_id == b"data":
 							self._data_offset = file_pos
-							# FIXME: Check chunk_size
+							if chunk_size not in [0, 0xFFFFFFFF]: # Otherwise still being written, or too big for the header
+								data_size = chunk_size
 
 						else:
 							pass
 
-						f.seek(file_pos + chunk_size, 0)
+						f.seek(file_pos + chunk_size + (chunk_size & 1), 0) # Chunks are word aligned
 				else:
 					raise Exception("Unknown RIFF type: {}".format(WAVE))
 			else:
@@ -153,21 +436,60 @@ class InputFile():
 				if self._freq is None:
 					self._freq = self._freq_hint
 
-		# FIXME: Timing file
-
 		self._item_factor = 1
+		if item_factor is not None:
+			self._item_factor = item_factor
+		elif self._format is not None and self._format == numpy.int16: # Interleaved I/Q
+			self._item_factor = 2
 		if self._format is not None:
-			if self._format == numpy.int16:
-				self._item_factor = 2
 			self._item_size = self._format.itemsize * self._item_factor
 
 		self._length = fileinfo.st_size - self._data_offset
+		if data_size is not None:
+			self._length = min(self._length, data_size) # Ignore chunks after the data
 
-		if manual_start_time and self._time_end is not None:
+		if self.duration() is None: # Unknown sample rate
+			pass
+		elif manual_start_time and self._time_end is not None:
 			self._time_start = self._time_end - datetime.timedelta(seconds=self.duration())
 		elif manual_end_time and self._time_start is not None:
 			self._time_end = self._time_start + datetime.timedelta(seconds=self.duration())
 
+		timing_path = self._timing_path
+		if timing_path is None and os.path.exists(self._path + TIMING_EXTENSION):
+			timing_path = self._path + TIMING_EXTENSION
+		if timing_path is not None:
+			self._load_timing(timing_path)
+
+	def _open_sigmf(self, path):
+		# Reads the SigMF metadata file at 'path' (for the first capture segment), and returns the number of components per sample
+		with open(path) as f:
+			meta = json.load(f)
+		self._file_type = "SigMF"
+		self._format, item_factor = _sigmf_format(meta['global']['core:datatype'])
+		self._samp_rate = meta['global'].get('core:sample_rate', self._samp_rate_hint)
+		self._freq = self._freq_hint
+		captures = meta.get('captures', [])
+		if len(captures) > 0:
+			self._freq = captures[0].get('core:frequency', self._freq)
+			self._data_offset = captures[0].get('core:header_bytes', 0)
+			if captures[0].get('core:datetime') is not None:
+				self._time_start = _parse_sigmf_time(captures[0]['core:datetime'])
+		return item_factor
+
+	def _load_timing(self, path):
+		samples, times, freqs = read_timing_file(path)
+		if len(samples) == 0:
+			return
+		if self._samp_rate is None:
+			raise Exception("Timing file {} needs the sample rate of {}".format(path, self._path))
+		time_origin = times[0]
+		seconds = numpy.array([(t - time_origin).total_seconds() for t in times], dtype=numpy.float64)
+		self._timing = (samples, seconds, time_origin, freqs)
+		self._timing_path = path
+		self._time_start = self.sample_time(0)
+		self._time_end = self.sample_time(self.samples())
+
 	def __str__(self):
 		return "{} ({} {}, {: >9} Hz, {: >9} samples, {: >5.1f} s, {} - {})".format(
 			self._path,
@@ -186,7 +508,7 @@ class InputFile():
 	def samples(self):
 		if self._item_size == 0:
 			return 0
-		return self._length / self._item_size
+		return self._length // self._item_size
 
 	def seek(self, offset):
 		if self._f is None:
@@ -206,24 +528,121 @@ class InputFile():
 
 		offset_bytes = self._f.tell()
 		offset_bytes -= self._data_offset
-		offset = offset_bytes / self._item_size
+		offset = offset_bytes // self._item_size
 		return offset
 
 	def read(self, length):
 		if length <= 0:
-			return ""
+			return b""
 
-		if self._f is not None:
+		if self._f is None:
 			self.open()
 
 		return self._f.read(length * self._item_size)
 
-	def memmap(self):
+	def read_samples(self, length, normalise=True):
+		# Interleaved int16 I/Q is converted to complex64 (scaled to [-1,1] if 'normalise'), other formats are returned as stored
+		return _to_samples(self.read(length), self._format, self._item_factor, normalise)
+
+	def convert(self, items, dtype=numpy.complex64, normalise=True):
+		# Converts stored items (e.g. a slice of 'memmap') to 'dtype' samples, as 'read_samples' does (integers keep the shape of 'items')
+		shape = (len(items),)
+		if not numpy.issubdtype(dtype, numpy.inexact):
+			shape = items.shape
+		samps = numpy.empty(shape, dtype=dtype)
+		_convert_into(samps, items, self._format, normalise)
+		return samps
+
+	def sample_time(self, sample):
+		# Time at which 'sample' was recorded, from the timing file if there is one
+		if self._timing is None:
+			if self._time_start is None or self._samp_rate is None:
+				return None
+			return self._time_start + datetime.timedelta(seconds=(1. * sample / self._samp_rate))
+		samples, seconds, time_origin, freqs = self._timing
+		i = max(0, numpy.searchsorted(samples, sample, 'right') - 1)   # Last entry at or before 'sample' (or the first)
+		return time_origin + datetime.timedelta(seconds=(seconds[i] + (1. * (sample - samples[i]) / self._samp_rate)))
+
+	def time_sample(self, t):
+		# Index of the first sample recorded at or after 't' (a 'datetime'), clipped to the file. Times in a drop map to the sample after it.
+		if self._timing is None:
+			if self._time_start is None or self._samp_rate is None:
+				raise Exception("Start time or sample rate of {} is unknown".format(self._path))
+			sample = _ceil_samples((t - self._time_start).total_seconds(), self._samp_rate)
+			return max(0, min(sample, self.samples()))
+		samples, seconds, time_origin, freqs = self._timing
+		t = (t - time_origin).total_seconds()
+		i = max(0, numpy.searchsorted(seconds, t, 'right') - 1)    # Last entry at or before 't' (or the first)
+		sample = samples[i] + _ceil_samples(t - seconds[i], self._samp_rate)
+		if (i + 1) < len(samples):
+			sample = min(sample, samples[i + 1])
+		return int(max(0, min(sample, self.samples())))
+
+	def sample_freq(self, sample):
+		# Frequency at 'sample', following any retunes in the timing file
+		if self._timing is not None:
+			samples, seconds, time_origin, freqs = self._timing
+			i = numpy.searchsorted(samples, sample, 'right') - 1
+			valid = numpy.nonzero(~numpy.isnan(freqs[:max(0, i + 1)]))[0]
+			if len(valid) > 0:
+				return float(freqs[valid[-1]])
+		return self._freq
+
+	def timing(self):
+		# (sample indices, times, frequencies) of the timing file entries, or None
+		if self._timing is None:
+			return None
+		samples, seconds, time_origin, freqs = self._timing
+		return (samples, [time_origin + datetime.timedelta(seconds=x) for x in seconds], freqs)
+
+	def envelope(self, build=True, verbose=False):
+		# The 'power_envelope.PowerEnvelope' of this recording, built on first use (see 'power_envelope.open_envelope')
+		import power_envelope
+		return power_envelope.open_envelope(self, build=build, verbose=verbose)
+
+	def seek_time(self, t):
+		# Opens the file (if necessary) at the first sample recorded at or after 't', and returns its index
+		sample = self.time_sample(t)
+		self.open(sample)
+		return sample
+
+	def read_time_range(self, time_start, time_end, normalise=True):
+		# Samples recorded from 'time_start' up to 'time_end' (see 'read_samples'). Empty if the range is empty or past the end of the file.
+		sample_start = self.seek_time(time_start)
+		length = self.time_sample(time_end) - sample_start
+		if length <= 0:
+			return _to_samples(b"", self._format, self._item_factor, normalise)
+		return self.read_samples(length, normalise)
+
+	def memmap(self, start=0, length=None):
+		# Read-only view of samples ['start', 'start' + 'length') straight from the data region (nothing is read until it is used).
+		# Interleaved I/Q formats (e.g. int16) have shape (samples, 2), others (e.g. complex64) have shape (samples,).
 		if self._format is None:
 			return None
-		if (self._data_offset % self._format.itemsize) != 0:
-			raise Exception("Cannot use memmap where data offset {} is not divisble by item size {}".format(self._data_offset, self._format.itemsize))
-		return numpy.memmap(self._path, self._format, 'r')
+		start, length = _clip_range(self.samples(), start, length)
+		shape = (length,)
+		if self._item_factor > 1:
+			shape = (length, self._item_factor)
+		if length == 0:
+			return numpy.zeros(shape, dtype=self._format) # 'numpy.memmap' cannot map an empty region
+		return numpy.memmap(self._path, self._format, 'r', offset=(self._data_offset + (start * self._item_size)), shape=shape)
+
+	def iter_blocks(self, block_samples, overlap=0, dtype=numpy.complex64, start=0, length=None, prefetch=PREFETCH_BLOCKS, normalise=True):
+		# Yields successive blocks of up to 'block_samples' samples from 'start' (for 'length' samples, or to the end of the file).
+		# Each block begins with the last 'overlap' samples of the previous one. Blocks are converted to 'dtype' like 'read_samples',
+		# or are the stored items (shaped like 'memmap') if 'dtype' is None or an integer type.
+		# A background thread reads up to 'prefetch' blocks ahead into recycled buffers, and yielded arrays are recycled too:
+		# a block is only valid until the next one is requested (copy it to keep it).
+		if self._format is None:
+			raise Exception("Unknown sample format of {}".format(self._path))
+		start, length = _clip_range(self.samples(), start, length)
+		if length == 0:
+			return
+
+		f = open(self._path, 'rb', buffering=0)
+		f.seek(self._data_offset + (start * self._item_size))
+		for block in _iter_blocks(f, self._format, self._item_factor, length, block_samples, overlap, dtype, prefetch, normalise):
+			yield block
 
 	def data_offset(self, raw_item_size=False):
 		if raw_item_size:
@@ -231,10 +650,10 @@ class InputFile():
 				return None
 			assert((self._format.itemsize * self._item_factor) == self._item_size)
 			assert((self._data_offset % self._format.itemsize) == 0)
-			return (self._data_offset / self._format.itemsize)
+			return (self._data_offset // self._format.itemsize)
 
 		assert((self._data_offset % self._item_size) == 0)
-		return (self._data_offset / self._item_size)
+		return (self._data_offset // self._item_size)
 
 	def open(self, offset=0):
 		if self._f is None:
@@ -246,10 +665,20 @@ class InputFile():
 	def close(self):
 		if self._f is not None:
 			self._f.close()
+			self._f = None
 
 	def format(self):
 		return self._format
 
+	def file_type(self):
+		return self._file_type
+
+	def data_offset_bytes(self):
+		return self._data_offset
+
+	def length(self): # Bytes of sample data
+		return self._length
+
 	def type_code(self):
 		if self._format is None:
 			return None
@@ -283,3 +712,255 @@ class InputFile():
 
 	def time_end(self):
 		return self._time_end
+
+class _SegmentReader():
+	# Reads the sample data of consecutive segments as one stream, starting 'offset' samples into segment 'index' (for 'iter_blocks')
+	def __init__(self, segments, index, offset):
+		self._segments = segments
+		self._index = index
+		self._f = None
+		self._remaining = 0 # Bytes left in the current segment
+		self._open(offset)
+
+	def _open(self, offset=0):
+		segment = self._segments[self._index]
+		self._f = open(segment.path(), 'rb', buffering=0)
+		self._f.seek(segment.data_offset_bytes() + (offset * segment.item_size()))
+		self._remaining = (segment.samples() - offset) * segment.item_size()    # Excludes a partial item at the end of the file
+
+	def readinto(self, buf):
+		view = memoryview(buf)
+		while self._f is not None:
+			if self._remaining > 0:
+				n = self._f.readinto(view[:min(len(view), self._remaining)])
+				if n:
+					self._remaining -= n
+					return n
+			self._f.close()
+			self._f = None
+			if (self._index + 1) < len(self._segments):
+				self._index += 1
+				self._open()
+		return 0
+
+	def close(self):
+		if self._f is not None:
+			self._f.close()
+			self._f = None
+
+# Several recordings (e.g. a long session split into files) read as one, in order of 'time_start' (then path).
+# Sample indices run continuously across the files (any gap in time between them is not represented).
+# The API is that of 'InputFile'. 'paths' may also contain 'InputFile's. At most 'max_open' files are kept open at once.
+class MultiInputFile():
+	def __init__(self, paths, format_hint=None, samp_rate_hint=None, freq_hint=None, max_open=MAX_OPEN_SEGMENTS):
+		self._args = ([(path.path() if isinstance(path, InputFile) else path) for path in paths], format_hint, samp_rate_hint, freq_hint, max_open) # To re-create it (e.g. in another process)
+		self._max_open = max(1, max_open)
+
+		segments = []
+		for path in paths:
+			if not isinstance(path, InputFile):
+				path = InputFile(path, format_hint, samp_rate_hint, freq_hint)
+			segments += [path]
+		if len(segments) == 0:
+			raise Exception("No files supplied")
+		segments.sort(key=lambda f: (f.time_start() is None, f.time_start() or datetime.datetime.min, f.path()))
+
+		first = segments[0]
+		for segment in segments[1:]:
+			if (segment.format(), segment.item_size(), segment.sample_rate()) != (first.format(), first.item_size(), first.sample_rate()):
+				raise Exception("Format of {} ({}, {} Hz) does not match {} ({}, {} Hz)".format(segment.path(), segment.format(), segment.sample_rate(), first.path(), first.format(), first.sample_rate()))
+		self._segments = segments
+
+		self._starts = [0] # Sample index of the start of each segment (and the end of the last)
+		for segment in segments:
+			self._starts += [self._starts[-1] + segment.samples()]
+
+		self._open_segments = collections.OrderedDict()    # Index: segment, least recently used first
+		self._position = None   # None when closed
+
+	def __str__(self):
+		return "{} files from {} ({} {}, {: >9} Hz, {: >9} samples, {: >5.1f} s, {} - {})".format(
+			len(self._segments),
+			self.path(),
+			self._segments[0].file_type(),
+			self.format(),
+			self.sample_rate(),
+			self.samples(),
+			self.duration() or 0,
+			str(self.time_start())[:-3] if self.time_start() is not None else "?",
+			str(self.time_end())[:-3] if self.time_end() is not None else "?",
+		)
+
+	def args(self):
+		return self._args
+
+	def segments(self):
+		return list(self._segments)
+
+	def segment_starts(self):
+		return self._starts[:-1]
+
+	def locate(self, offset):
+		# (segment index, offset within the segment) of sample 'offset'
+		index = max(0, bisect.bisect_right(self._starts, offset, 0, len(self._segments)) - 1)
+		return (index, offset - self._starts[index])
+
+	def path(self):
+		return self._segments[0].path()
+
+	def paths(self):
+		return [segment.path() for segment in self._segments]
+
+	def samples(self):
+		return self._starts[-1]
+
+	def _segment(self, index):
+		# Open segment 'index', closing the least recently used if there are too many
+		segment = self._open_segments.pop(index, None)
+		if segment is None:
+			while len(self._open_segments) >= self._max_open:
+				self._open_segments.popitem(last=False)[1].close()
+			segment = self._segments[index]
+			segment.open()
+		self._open_segments[index] = segment
+		return segment
+
+	def seek(self, offset):
+		# Unlike 'InputFile.seek', returns the new sample offset
+		if self._position is None:
+			return -1
+		if offset < 0:
+			offset += self.samples()
+		self._position = max(0, offset)
+		return self._position
+
+	def tell(self):
+		if self._position is None:
+			return -1
+		return self._position
+
+	def read(self, length):
+		if length <= 0:
+			return b""
+
+		if self._position is None:
+			self.open()
+
+		data = []
+		while length > 0 and self._position < self.samples():
+			index, offset = self.locate(self._position)
+			num = min(length, self._starts[index + 1] - self._position)
+			segment = self._segment(index)
+			segment.seek(offset)
+			data += [segment.read(num)]
+			self._position += num
+			length -= num
+		return b"".join(data)
+
+	def read_samples(self, length, normalise=True):
+		return _to_samples(self.read(length), self.format(), self.item_factor(), normalise)
+
+	def convert(self, items, dtype=numpy.complex64, normalise=True):
+		return self._segments[0].convert(items, dtype, normalise)
+
+	def sample_time(self, sample):
+		index, offset = self.locate(sample)
+		return self._segments[index].sample_time(offset)
+
+	def time_sample(self, t):
+		# As 'InputFile.time_sample'. Times between files map to the start of the next file.
+		index = 0
+		for i, segment in enumerate(self._segments):
+			if segment.time_start() is not None and segment.time_start() <= t:
+				index = i
+		return self._starts[index] + self._segments[index].time_sample(t)
+
+	def sample_freq(self, sample):
+		index, offset = self.locate(sample)
+		return self._segments[index].sample_freq(offset)
+
+	def seek_time(self, t):
+		sample = self.time_sample(t)
+		self.open(sample)
+		return sample
+
+	def read_time_range(self, time_start, time_end, normalise=True):
+		sample_start = self.seek_time(time_start)
+		length = self.time_sample(time_end) - sample_start
+		if length <= 0:
+			return _to_samples(b"", self.format(), self.item_factor(), normalise)
+		return self.read_samples(length, normalise)
+
+	def memmap(self, start=0, length=None):
+		# As 'InputFile.memmap'. A range within one file is a view, a range across files is copied into one array.
+		if self.format() is None:
+			return None
+		start, length = _clip_range(self.samples(), start, length)
+		parts = []
+		while length > 0:
+			index, offset = self.locate(start)
+			num = min(length, self._starts[index + 1] - start)
+			parts += [self._segments[index].memmap(offset, num)]
+			start += num
+			length -= num
+		if len(parts) == 0:
+			return self._segments[0].memmap(0, 0)
+		if len(parts) == 1:
+			return parts[0]
+		return numpy.concatenate(parts)
+
+	def iter_blocks(self, block_samples, overlap=0, dtype=numpy.complex64, start=0, length=None, prefetch=PREFETCH_BLOCKS, normalise=True):
+		# As 'InputFile.iter_blocks': blocks run across file boundaries
+		if self.format() is None:
+			raise Exception("Unknown sample format of {}".format(self.path()))
+		start, length = _clip_range(self.samples(), start, length)
+		if length == 0:
+			return
+
+		index, offset = self.locate(start)
+		f = _SegmentReader(self._segments, index, offset)
+		for block in _iter_blocks(f, self.format(), self.item_factor(), length, block_samples, overlap, dtype, prefetch, normalise):
+			yield block
+
+	def open(self, offset=0):
+		if self._position is None:
+			self._position = 0
+		self.seek(offset)
+		return self
+
+	def close(self):
+		while len(self._open_segments) > 0:
+			self._open_segments.popitem()[1].close()
+		self._position = None
+
+	def format(self):
+		return self._segments[0].format()
+
+	def file_type(self):
+		return self._segments[0].file_type()
+
+	def type_code(self):
+		return self._segments[0].type_code()
+
+	def sample_rate(self):
+		return self._segments[0].sample_rate()
+
+	def duration(self):
+		if self.sample_rate() is None:
+			return None
+		return 1.*self.samples() / self.sample_rate()
+
+	def freq(self):
+		return self._segments[0].freq()
+
+	def item_size(self):
+		return self._segments[0].item_size()
+
+	def item_factor(self):
+		return self._segments[0].item_factor()
+
+	def time_start(self):
+		return self._segments[0].time_start()
+
+	def time_end(self):
+		return self._segments[-1].time_end()
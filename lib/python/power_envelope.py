@@ -0,0 +1,245 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#  power_envelope.py
+#
+#  Copyright 2014 Balint Seeber <balint256@gmail.com>
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#  MA 02110-1301, USA.
+#
+#
+
+import os, json, datetime
+
+import numpy
+
+import input_file
+
+ENVELOPE_EXTENSION = ".envelope"    # Appended to a recording's path for its envelope file
+ENVELOPE_BASE_BLOCK = 256   # Samples summarised by each entry of the finest level
+ENVELOPE_FACTOR = 8 # Blocks of a level summarised by each entry of the next (coarser) level
+ENVELOPE_HEADER_ALIGN = 4096    # Levels start on this boundary
+ENVELOPE_CHUNK_BLOCKS = 2**16   # Entries of a level reduced at a time when building the next
+DEFAULT_BLOCK_SAMPLES = 2**20   # Samples read from the recording at a time (rounded down to a whole number of base blocks)
+
+envelope_dtype = numpy.dtype([
+    ('min', numpy.float32), # Smallest sample power in the block (linear)
+    ('max', numpy.float32), # Largest sample power
+    ('mean', numpy.float32),    # Average sample power
+])
+
+def _level_sizes(samples, base_block, factor):
+    # Number of entries in each level, from the finest down to a single entry
+    sizes = [max(1, (samples + base_block - 1) // base_block)]
+    while sizes[-1] > 1:
+        sizes += [(sizes[-1] + factor - 1) // factor]
+    return sizes
+
+def _block_weights(first, count, block, samples):
+    # Samples in blocks 'first' to 'first + count' of 'block' samples (the last block of the recording may be partial)
+    starts = numpy.arange(first, first + count, dtype=numpy.float64) * block
+    return numpy.maximum(numpy.minimum(starts + block, samples) - starts, 0)
+
+def _reduce_blocks(entries, indices, weights):
+    # Combines the runs of 'entries' starting at each of 'indices' into one entry each
+    out = numpy.zeros(len(indices), dtype=envelope_dtype)
+    out['min'] = numpy.minimum.reduceat(entries['min'], indices)
+    out['max'] = numpy.maximum.reduceat(entries['max'], indices)
+    total = numpy.add.reduceat(weights, indices)
+    out['mean'] = numpy.add.reduceat(entries['mean'] * weights, indices) / numpy.maximum(total, 1)
+    return out
+
+# Summarises the sample power of 'source' (a path, 'InputFile' or 'MultiInputFile') in one streaming pass, and writes the
+# result to 'output_path' (by default the recording's path plus 'ENVELOPE_EXTENSION').
+# Level 0 has the min/max/mean power of every 'base_block' samples, and each further level combines 'factor' entries of the previous one.
+# The file starts with a line of JSON describing the levels, padded to 'ENVELOPE_HEADER_ALIGN' bytes, followed by the levels
+# as arrays of 'envelope_dtype'. Use 'PowerEnvelope' to query it.
+def build_envelope(source, output_path=None, base_block=ENVELOPE_BASE_BLOCK, factor=ENVELOPE_FACTOR, block_samples=DEFAULT_BLOCK_SAMPLES, verbose=False):
+    f = source
+    if not isinstance(f, (input_file.InputFile, input_file.MultiInputFile)):
+        f = input_file.InputFile(source)
+    if output_path is None:
+        if isinstance(f, input_file.MultiInputFile):
+            raise Exception("An output path is needed for the envelope of several files")
+        output_path = f.path() + ENVELOPE_EXTENSION
+
+    samples = f.samples()
+    sizes = _level_sizes(samples, base_block, factor)
+    levels = []
+    offset = 0
+    for i, size in enumerate(sizes):
+        levels += [{'block': base_block * (factor ** i), 'entries': size, 'offset': offset}]
+        offset += size
+
+    header = {
+        'source': f.path(),
+        'samples': samples,
+        'samp_rate': f.sample_rate(),
+        'freq': f.freq(),
+        'time_start': (str(f.time_start()) if f.time_start() is not None else None),
+        'base_block': base_block,
+        'factor': factor,
+        'levels': levels,
+        'dtype': envelope_dtype.descr,
+    }
+    text = json.dumps(header)
+    header_size = ((len(text) + 1 + ENVELOPE_HEADER_ALIGN - 1) // ENVELOPE_HEADER_ALIGN) * ENVELOPE_HEADER_ALIGN  # Including the newline
+
+    if verbose: print("Writing %d-level envelope of %d samples to %s" % (len(levels), samples, output_path))
+
+    with open(output_path, 'wb') as out:
+        out.write((text.ljust(header_size - 1) + '\n').encode('ascii'))
+        out.truncate(header_size + (offset * envelope_dtype.itemsize))
+
+    data = numpy.memmap(output_path, dtype=envelope_dtype, mode='r+', offset=header_size, shape=(offset,))
+
+    # Level 0, from the samples
+    level = data[:sizes[0]]
+    block_samples = max(1, block_samples // base_block) * base_block
+    idx = 0
+    for samps in f.iter_blocks(block_samples):
+        power = numpy.square(samps.real, dtype=numpy.float64)
+        power += numpy.square(samps.imag)
+        num_full = len(power) // base_block
+        if num_full > 0:
+            blocks = power[:num_full*base_block].reshape(num_full, base_block)
+            level['min'][idx:idx+num_full] = blocks.min(axis=1)
+            level['max'][idx:idx+num_full] = blocks.max(axis=1)
+            level['mean'][idx:idx+num_full] = blocks.mean(axis=1)
+            idx += num_full
+        tail = power[num_full*base_block:]
+        if len(tail) > 0:   # Only at the end of the recording
+            level[idx] = (tail.min(), tail.max(), tail.mean())
+            idx += 1
+
+    # Coarser levels, each from the previous one
+    for i in range(1, len(levels)):
+        previous = data[levels[i-1]['offset']:levels[i-1]['offset']+sizes[i-1]]
+        level = data[levels[i]['offset']:levels[i]['offset']+sizes[i]]
+        chunk = ENVELOPE_CHUNK_BLOCKS * factor
+        for first in range(0, sizes[i-1], chunk):
+            entries = previous[first:first+chunk]
+            weights = _block_weights(first, len(entries), levels[i-1]['block'], samples)
+            level[first//factor:(first+len(entries)+factor-1)//factor] = _reduce_blocks(entries, numpy.arange(0, len(entries), factor), weights)
+
+    data.flush()
+    del data
+
+    return header
+
+# Reads a file written by 'build_envelope'. 'overview' serves a summary of any range from the coarsest level that still has
+# at least one entry per column, so its cost depends on the width and not on the length of the range.
+class PowerEnvelope():
+    def __init__(self, path):
+        self._path = path
+        with open(path, 'rb') as f:
+            self._header = json.loads(f.readline().decode('ascii'))
+            header_size = f.tell()  # The header line is padded up to the levels
+        self._levels = []
+        total = sum([level['entries'] for level in self._header['levels']])
+        data = numpy.memmap(path, dtype=envelope_dtype, mode='r', offset=header_size, shape=(total,))
+        for level in self._header['levels']:
+            self._levels += [data[level['offset']:level['offset']+level['entries']]]
+
+    def header(self):
+        return self._header
+
+    def samples(self):
+        return self._header['samples']
+
+    def num_levels(self):
+        return len(self._levels)
+
+    def level(self, index):
+        # Read-only memory-mapped array of 'envelope_dtype', one entry per 'block_samples(index)' samples
+        return self._levels[index]
+
+    def block_samples(self, index):
+        return self._header['levels'][index]['block']
+
+    def overview(self, start=0, length=None, width=1024, log_scale=False):
+        # (min, max, mean) power of 'width' equal columns spanning samples 'start' to 'start + length' (in dB if 'log_scale')
+        samples = self.samples()
+        start = max(0, min(start, samples))
+        if length is None:
+            length = samples - start
+        length = max(0, min(length, samples - start))
+        width = int(width)
+        if length == 0 or width <= 0:
+            return tuple([numpy.zeros(0, dtype=numpy.float32) for field in envelope_dtype.names])
+
+        samples_per_column = 1. * length / width
+        index = 0
+        while (index + 1) < len(self._levels) and self.block_samples(index + 1) <= samples_per_column:
+            index += 1
+        block = self.block_samples(index)
+        level = self._levels[index]
+
+        edges = start + ((numpy.arange(width + 1) * length) // width)
+        first = edges[:-1] // block
+        last = numpy.maximum((edges[1:] - 1) // block, first)   # Columns narrower than a block repeat it
+        begin = first[0]
+        end = last[-1] + 1
+        entries = level[begin:end]
+        weights = _block_weights(begin, end - begin, block, samples)
+
+        out = _reduce_blocks(entries, first - begin, weights)
+        numpy.minimum(out['min'], entries['min'][last - begin], out=out['min'])   # Also include a block shared with the next column
+        numpy.maximum(out['max'], entries['max'][last - begin], out=out['max'])
+        result = [out[field] for field in envelope_dtype.names]
+        if log_scale:
+            with numpy.errstate(divide='ignore'):
+                result = [10.0 * numpy.log10(x) for x in result]
+        return tuple(result)
+
+    def overview_time(self, time_start, time_end, width=1024, log_scale=False, source=None):
+        # As 'overview', for the range from 'time_start' to 'time_end' ('datetime's). Times are looked up with 'source.time_sample'
+        # (an 'InputFile', which takes the recording's timing file into account), otherwise from the start time and sample rate.
+        if source is not None:
+            start = source.time_sample(time_start)
+            end = source.time_sample(time_end)
+        else:
+            if self._header['time_start'] is None or self._header['samp_rate'] is None:
+                raise Exception("Start time or sample rate of {} is unknown".format(self._header['source']))
+            time_format = "%Y-%m-%d %H:%M:%S"
+            if '.' in self._header['time_start']:
+                time_format += ".%f"
+            origin = datetime.datetime.strptime(self._header['time_start'], time_format)
+            start = int(round((time_start - origin).total_seconds() * self._header['samp_rate']))
+            end = int(round((time_end - origin).total_seconds() * self._header['samp_rate']))
+        return self.overview(start, end - start, width, log_scale)
+
+# The 'PowerEnvelope' of 'source' (see 'build_envelope'), building it first if 'build' and the envelope file is missing
+# or older than the recording. Other keywords are passed to 'build_envelope'.
+def open_envelope(source, path=None, build=True, verbose=False, **kwds):
+    f = source
+    if not isinstance(f, (input_file.InputFile, input_file.MultiInputFile)):
+        f = input_file.InputFile(source)
+    if path is None:
+        path = f.path() + ENVELOPE_EXTENSION
+
+    paths = [f.path()]
+    if isinstance(f, input_file.MultiInputFile):
+        paths = f.paths()
+    stale = (not os.path.exists(path)) or (os.path.getmtime(path) < max([os.path.getmtime(p) for p in paths]))
+    if not stale:
+        envelope = PowerEnvelope(path)
+        if envelope.samples() == f.samples():
+            return envelope
+    if not build:
+        return None
+    build_envelope(f, path, verbose=verbose, **kwds)
+    return PowerEnvelope(path)
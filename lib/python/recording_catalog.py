@@ -0,0 +1,210 @@
+#!/usr/bin/env python
+#
+# Copyright 2018 Balint Seeber
+#
+# This is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3, or (at your option)
+# any later version.
+#
+# This software is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this software; see the file COPYING.  If not, write to
+# the Free Software Foundation, Inc., 51 Franklin Street,
+# Boston, MA 02110-1301, USA.
+#
+
+import os, collections, datetime, sqlite3
+import numpy
+
+import input_file
+
+CATALOG_DIR = ".catalog" # Sidecar directory created in the root of the archive
+CATALOG_FILE = "recordings.sqlite"
+RECORDING_EXTENSIONS = [".wav", ".raw", ".sc16", ".sigmf-data"]
+
+_EPOCH = datetime.datetime(1970, 1, 1) # Times are naive (as in 'InputFile'), and stored as seconds since this
+
+CatalogEntry = collections.namedtuple('CatalogEntry', ['path', 'file_type', 'format', 'samp_rate', 'freq', 'time_start', 'time_end', 'data_offset', 'length', 'samples', 'size', 'mtime'])
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS recordings (
+	path TEXT PRIMARY KEY,
+	size INTEGER,
+	mtime REAL,
+	sidecars TEXT,
+	error TEXT,
+	file_type TEXT,
+	format TEXT,
+	samp_rate REAL,
+	freq REAL,
+	freq_low REAL,
+	freq_high REAL,
+	time_start REAL,
+	time_end REAL,
+	data_offset INTEGER,
+	length INTEGER,
+	samples INTEGER
+);
+CREATE INDEX IF NOT EXISTS recordings_freq ON recordings (freq_low, freq_high);
+CREATE INDEX IF NOT EXISTS recordings_time ON recordings (time_start, time_end);
+"""
+
+def _sidecar_paths(path):
+	# Files next to a recording that also set its metadata
+	paths = [path + input_file.TIMING_EXTENSION]
+	base, extension = os.path.splitext(path)
+	if extension.lower() == input_file.SIGMF_DATA_EXTENSION:
+		paths += [base + input_file.SIGMF_META_EXTENSION]  # All of a SigMF recording's metadata
+	return paths
+
+def _sidecars(path):
+	# Size and modification time of the sidecars of 'path' that exist, so a recording is re-catalogued when one changes
+	info = []
+	for sidecar in _sidecar_paths(path):
+		if os.path.exists(sidecar):
+			fileinfo = os.stat(sidecar)
+			info += ["{} {} {!r}".format(os.path.basename(sidecar), fileinfo.st_size, fileinfo.st_mtime)]
+	return "\n".join(info)
+
+_COLUMNS = ['path', 'file_type', 'format', 'samp_rate', 'freq', 'time_start', 'time_end', 'data_offset', 'length', 'samples', 'size', 'mtime']
+
+def _to_seconds(t):
+	if t is None:
+		return None
+	return (t - _EPOCH).total_seconds()
+
+def _from_seconds(t):
+	if t is None:
+		return None
+	return _EPOCH + datetime.timedelta(seconds=t)
+
+# Persistent index of the 'InputFile' metadata of every recording under 'root', kept in an SQLite database in a sidecar directory.
+# 'refresh' only re-opens recordings whose size or modification time changed, so later runs cost little more than a directory walk.
+# The hints are passed to 'InputFile' for recordings whose format cannot be determined from the file.
+class RecordingCatalog():
+	def __init__(self, root, catalog_dir=None, format_hint=None, samp_rate_hint=None, freq_hint=None, extensions=RECORDING_EXTENSIONS):
+		self._root = os.path.abspath(root)
+		if catalog_dir is None:
+			catalog_dir = os.path.join(self._root, CATALOG_DIR)
+		self._catalog_dir = os.path.abspath(catalog_dir)
+		self._hints = (format_hint, samp_rate_hint, freq_hint)
+		self._extensions = [extension.lower() for extension in extensions]
+
+		if not os.path.isdir(self._catalog_dir):
+			os.makedirs(self._catalog_dir)
+		self._db = sqlite3.connect(os.path.join(self._catalog_dir, CATALOG_FILE))
+		self._db.executescript(_SCHEMA)
+		if 'sidecars' not in [row[1] for row in self._db.execute("PRAGMA table_info(recordings)")]:
+			with self._db:  # Catalogs from before sidecars were tracked: every recording is re-catalogued once
+				self._db.execute("ALTER TABLE recordings ADD COLUMN sidecars TEXT")
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		self.close()
+
+	def close(self):
+		if self._db is not None:
+			self._db.close()
+			self._db = None
+
+	def root(self):
+		return self._root
+
+	def _walk(self):
+		for dirpath, dirnames, filenames in os.walk(self._root):
+			dirnames[:] = [d for d in dirnames if os.path.join(dirpath, d) != self._catalog_dir]
+			for filename in filenames:
+				if os.path.splitext(filename)[1].lower() in self._extensions:
+					path = os.path.join(dirpath, filename)
+					yield os.path.relpath(path, self._root), path
+
+	def _describe(self, path):
+		# Row values for a recording (the error is kept, so a bad file is not re-opened until it changes)
+		try:
+			f = input_file.InputFile(path, *self._hints)
+		except Exception as e:
+			return dict(error=str(e) or e.__class__.__name__)
+
+		row = dict(
+			error=None,
+			file_type=f.file_type(),
+			format=(f.format().str if f.format() is not None else None),
+			samp_rate=f.sample_rate(),
+			freq=f.freq(),
+			time_start=_to_seconds(f.time_start()),
+			time_end=_to_seconds(f.time_end()),
+			data_offset=f.data_offset_bytes(),
+			length=f.length(),
+			samples=f.samples(),
+			freq_low=None,
+			freq_high=None,
+		)
+		if f.freq() is not None and f.sample_rate() is not None:
+			row['freq_low'] = f.freq() - (f.sample_rate() / 2.0)
+			row['freq_high'] = f.freq() + (f.sample_rate() / 2.0)
+		return row
+
+	def refresh(self, verbose=False):
+		# Brings the catalog up to date with the files under the root (and their sidecars, e.g. timing files).
+		# Returns the number of (updated, removed) recordings.
+		known = dict([(path, (size, mtime, sidecars)) for path, size, mtime, sidecars in self._db.execute("SELECT path, size, mtime, sidecars FROM recordings")])
+		updated = 0
+		with self._db:
+			for relpath, path in self._walk():
+				fileinfo = os.stat(path)
+				sidecars = _sidecars(path)
+				if known.pop(relpath, None) == (fileinfo.st_size, fileinfo.st_mtime, sidecars):
+					continue
+				if verbose: print("Cataloguing {}".format(relpath))
+				row = self._describe(path)
+				row.update(path=relpath, size=fileinfo.st_size, mtime=fileinfo.st_mtime, sidecars=sidecars)
+				names = sorted(row.keys())
+				self._db.execute("INSERT OR REPLACE INTO recordings ({}) VALUES ({})".format(", ".join(names), ", ".join(["?"] * len(names))), [row[name] for name in names])
+				updated += 1
+			for relpath in known.keys():    # No longer on disk
+				if verbose: print("Removing {}".format(relpath))
+				self._db.execute("DELETE FROM recordings WHERE path = ?", (relpath,))
+		return (updated, len(known))
+
+	def _entry(self, row):
+		values = dict(zip(_COLUMNS, row))
+		values['path'] = os.path.join(self._root, values['path'])
+		if values['format'] is not None:
+			values['format'] = numpy.dtype(str(values['format']))
+		values['time_start'] = _from_seconds(values['time_start'])
+		values['time_end'] = _from_seconds(values['time_end'])
+		return CatalogEntry(**values)
+
+	def query(self, freq=None, time_start=None, time_end=None):
+		# Recordings whose band contains 'freq' (Hz) and whose time span overlaps 'time_start' to 'time_end' ('datetime's), sorted by start time.
+		# Criteria that are None are not applied. Recordings that could not be opened are never returned.
+		where = ["error IS NULL"]
+		args = []
+		if freq is not None:
+			where += ["freq_low <= ?", "freq_high >= ?"]
+			args += [freq, freq]
+		if time_start is not None:
+			where += ["time_end >= ?"]
+			args += [_to_seconds(time_start)]
+		if time_end is not None:
+			where += ["time_start <= ?"]
+			args += [_to_seconds(time_end)]
+		sql = "SELECT {} FROM recordings WHERE {} ORDER BY time_start, path".format(", ".join(_COLUMNS), " AND ".join(where))
+		return [self._entry(row) for row in self._db.execute(sql, args)]
+
+	def entries(self):
+		return self.query()
+
+	def errors(self):
+		# (path, error) of the recordings that could not be opened
+		return [(os.path.join(self._root, path), error) for path, error in self._db.execute("SELECT path, error FROM recordings WHERE error IS NOT NULL ORDER BY path")]
+
+	def open(self, entry):
+		return input_file.InputFile(entry.path, *self._hints)